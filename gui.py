@@ -157,32 +157,25 @@ class dirlist_control(wx.ListCtrl):
 		self.Bind(wx.EVT_LIST_ITEM_DESELECTED,
 			  self.evt_item_deselected)
 
-	def _update_dirtable(self, mc, dir):
+	def _update_dirtable(self, snapshot):
 		self.dirtable = table = []
 		enc = "unicode"
 		if self.config.get_ascii():
 			enc = "ascii"
-		for ent in dir:
-			if not ps2mc.mode_is_dir(ent[0]):
-				continue
-			dirname = "/" + ent[8]
-			s = mc.get_icon_sys(dirname)
+		for save in snapshot.saves:
+			s = save.icon_sys
 			if s == None:
 				continue
 			a = ps2save.unpack_icon_sys(s)
-			size = mc.dir_size(dirname)
+			size = save.entry.size * snapshot.cluster_size
 			title = ps2save.icon_sys_title(a, encoding = enc)
-			table.append((ent, s, size, title))
+			table.append((save.entry.dirent, s, size, title))
 		
 	def update_dirtable(self, mc):
 		self.dirtable = []
 		if mc == None:
 			return
-		dir = mc.dir_open("/")
-		try:
-			self._update_dirtable(mc, dir)
-		finally:
-			dir.close()
+		self._update_dirtable(mc.snapshot())
 
 	def get_dir_name(self, i):
 		return self.dirtable[i][0][8]
@@ -675,7 +668,7 @@ class gui_frame(wx.Frame):
 		f = None
 		try:
 			f = file(filename, "r+b")
-			mc = ps2mc.ps2mc(f)
+			mc = ps2mc.ps2mc(f, flat_fat = True)
 		except EnvironmentError, value:
 			if f != None:
 				f.close()
@@ -11,17 +11,19 @@ _SCCS_ID = "@(#) mymc mymc.py 1.13 22/01/15 01:04:45\n"[:-1]
 
 import sys
 import os
+import array
 import time
 import optparse
 import textwrap
 import binascii
 import string
-from errno import EEXIST, EIO
+from errno import EEXIST, EIO, ENOSPC
 
 #import gc
 #gc.set_debug(gc.DEBUG_LEAK)
 
 import ps2mc
+import ps2mc_ecc
 import ps2save
 from ps2mc_dir import *
 from round import *
@@ -87,11 +89,12 @@ def glob_args(args, globfn):
 def _copy(fout, fin):
 	"""copy the contents of one file to another"""
 	
+	buf = bytearray(65536)
 	while True:
-		s = fin.read(1024)
-		if s == "":
+		n = fin.readinto(buf)
+		if n == 0:
 			break
-		fout.write(s)
+		fout.write(buffer(buf, 0, n))
 	
 
 def do_ls(cmd, mc, opts, args, opterr):
@@ -103,33 +106,29 @@ def do_ls(cmd, mc, opts, args, opterr):
 	out = sys.stdout
 	args = glob_args(args, mc.glob)
 	for dirname in args:
-		dir = mc.dir_open(dirname)
-		try:
-			if len(args) > 1:
-				sys.stdout.write("\n" + dirname + ":\n")
-			for ent in dir:
-				mode = ent[0]
-				if (mode & DF_EXISTS) == 0:
-					continue
-				for bit in range(0, 15):
-					if mode & (1 << bit):
-						out.write(mode_bits[bit])
-					else:
-						out.write("-")
-				if opts.creation_time:
-					tod = ent[3]
+		dir = mc.dir_snapshot(dirname)
+		if len(args) > 1:
+			sys.stdout.write("\n" + dirname + ":\n")
+		for entry in dir.entries:
+			ent = entry.dirent
+			mode = ent[0]
+			for bit in range(0, 15):
+				if mode & (1 << bit):
+					out.write(mode_bits[bit])
 				else:
-					tod = ent[6]
-				tm = time.localtime(tod_to_time(tod))
-				out.write(" %7d %04d-%02d-%02d"
-					  " %02d:%02d:%02d %s\n"
-					  % (ent[2],
-					     tm.tm_year, tm.tm_mon, tm.tm_mday,
-					     tm.tm_hour, tm.tm_min, tm.tm_sec,
-					     ent[8]))
-		finally:
-			dir.close()
-			
+					out.write("-")
+			if opts.creation_time:
+				tod = ent[3]
+			else:
+				tod = ent[6]
+			tm = time.localtime(tod_to_time(tod))
+			out.write(" %7d %04d-%02d-%02d"
+				  " %02d:%02d:%02d %s\n"
+				  % (ent[2],
+				     tm.tm_year, tm.tm_mon, tm.tm_mday,
+				     tm.tm_hour, tm.tm_min, tm.tm_sec,
+				     ent[8]))
+		
 
 def do_add(cmd, mc, opts,  args, opterr):
 	if len(args) < 1:
@@ -336,20 +335,16 @@ def do_rename(cmd, mc, opts, args, opterr):
 		opterr("Old and new names required")
 	mc.rename(args[0], args[1])
 	
-def _get_ps2_title(mc, enc):
-	s = mc.get_icon_sys(".");
+def _get_ps2_title(save, enc):
+	s = save.icon_sys
 	if s == None:
 		return None
 	a = ps2save.unpack_icon_sys(s)
 	return ps2save.icon_sys_title(a, enc)
 
-def _get_psx_title(mc, savename, enc):
-	mode = mc.get_mode(savename)
-	if mode == None or not mode_is_file(mode):
-		return None
-	f = mc.open(savename)
-	s = f.read(128)
-	if len(s) != 128:
+def _get_psx_title(save, enc):
+	s = save.psx_header
+	if s == None:
 		return None
 	(magic, icon, blocks, title) = struct.unpack("<2sBB64s28x32x", s)
 	if magic != "SC":
@@ -359,51 +354,42 @@ def _get_psx_title(mc, savename, enc):
 def do_dir(cmd, mc, opts, args, opterr):
 	if len(args) != 0:
 		opterr("Incorrect number of arguments.")
-	f = None
-	dir = mc.dir_open("/")
-	try:
-		for ent in list(dir)[2:]:
-			dirmode = ent[0]
-			if not mode_is_dir(dirmode):
-				continue
-			dirname = "/" + ent[8]
-			mc.chdir(dirname)
-			length = mc.dir_size(".");
-			enc = getattr(sys.stdout, "encoding", None)
-			if dirmode & DF_PSX:
-				title = _get_psx_title(mc, ent[8], enc)
-			else:
-				title = _get_ps2_title(mc, enc)
-			if title == None:
-				title = ["Corrupt", ""]
-			protection = dirmode & (DF_PROTECTED | DF_WRITE)
-			if protection == 0:
-				protection = "Delete Protected"
-			elif protection == DF_WRITE:
-				protection = "Not Protected"
-			elif protection == DF_PROTECTED:
-				protection = "Copy & Delete Protected"
-			else:
-				protection = "Copy Protected"
-
-			type = None
-			if dirmode & DF_PSX:
-				type = "PlayStation"
-				if dirmode & DF_POCKETSTN:
-					type = "PocketStation"
-			if type != None:
-				protection = type
-				
-			print "%-32s %s" % (ent[8], title[0])
-			print ("%4dKB %-25s %s"
-			       % (length / 1024, protection, title[1]))
-			print
-	finally:
-		if f != None:
-			f.close()
-		dir.close()
-		
-	free = mc.get_free_space() / 1024
+	snapshot = mc.snapshot()
+	for save in snapshot.saves:
+		ent = save.entry.dirent
+		dirmode = ent[0]
+		length = save.entry.size * snapshot.cluster_size
+		enc = getattr(sys.stdout, "encoding", None)
+		if dirmode & DF_PSX:
+			title = _get_psx_title(save, enc)
+		else:
+			title = _get_ps2_title(save, enc)
+		if title == None:
+			title = ["Corrupt", ""]
+		protection = dirmode & (DF_PROTECTED | DF_WRITE)
+		if protection == 0:
+			protection = "Delete Protected"
+		elif protection == DF_WRITE:
+			protection = "Not Protected"
+		elif protection == DF_PROTECTED:
+			protection = "Copy & Delete Protected"
+		else:
+			protection = "Copy Protected"
+
+		type = None
+		if dirmode & DF_PSX:
+			type = "PlayStation"
+			if dirmode & DF_POCKETSTN:
+				type = "PocketStation"
+		if type != None:
+			protection = type
+			
+		print "%-32s %s" % (ent[8], title[0])
+		print ("%4dKB %-25s %s"
+		       % (length / 1024, protection, title[1]))
+		print
+	
+	free = snapshot.free_clusters * snapshot.cluster_size / 1024
 	if free > 999999:
 		free = "%d,%03d,%03d" % (free / 1000000, free / 1000 % 1000,
 					 free % 1000)
@@ -427,6 +413,47 @@ def do_check(cmd, mc, opts, args, opterr):
 		return 0
 	return 1
 	
+def do_scan(cmd, mc, opts, args, opterr):
+	if len(args) != 0:
+		opterr("Incorrect number of arguments.")
+	report = mc.scan(opts.jobs)
+	print ("%d pages: %d clean, %d erased, %d corrected,"
+	       " %d uncorrectable" % (report["pages"], report["clean"],
+				      report["erased"],
+				      len(report["corrected"]),
+				      len(report["failed"])))
+	for (title, pages) in [("corrected", report["corrected"]),
+			       ("uncorrectable", report["failed"])]:
+		if len(pages) != 0:
+			print title + ":",
+			print " ".join(["%05x" % page for page in pages])
+	print "read %d KB in %.2f seconds (%.2f MB/s)" % (
+		report["bytes"] / 1024, report["seconds"],
+		report["throughput"] / (1024 * 1024))
+	if len(report["failed"]) != 0:
+		return 1
+	return 0
+
+def do_scrub(cmd, mc, opts, args, opterr):
+	if len(args) != 0:
+		opterr("Incorrect number of arguments.")
+	report = mc.scrub()
+	print ("%d pages: %d clean, %d erased, %d corrected,"
+	       " %d uncorrectable" % (report["pages"], report["clean"],
+				      report["erased"],
+				      len(report["corrected"]),
+				      len(report["failed"])))
+	blocks = report["blocks"].keys()
+	blocks.sort()
+	for block in blocks:
+		print "erase block %04x: %d pages corrected" % (
+			block, report["blocks"][block])
+	if len(report["failed"]) != 0:
+		print "uncorrectable:",
+		print " ".join(["%05x" % page for page in report["failed"]])
+		return 1
+	return 0
+
 def do_format(cmd, mcname, opts, args, opterr):
 	if len(args) != 0:
 		opterr("Incorrect number of arguments.")
@@ -475,8 +502,11 @@ def do_create_pad(cmd, mc, opts, args, opterr):
 	pad = "\0" * mc.cluster_size
 	f = mc.open(args[0], "wb")
 	try:
-		for i in xrange(length):
-			f.write(pad)
+		free = mc.get_free_space() / mc.cluster_size
+		f.write_all(pad * min(length, free))
+		if length > free:
+			raise io_error, (ENOSPC, "out of space on image",
+					 args[0])
 	finally:
 		f.close()
 	
@@ -502,6 +532,124 @@ def _print_erase_block(mc, n):
 		_print_bin(i * mc.page_size, s)
 		print
 		
+def _hot_pass(mc, dirs):
+	"""Return the buffer pool hit rate of a pass over a few saves."""
+	
+	(hits, misses) = mc.buffer_pool.stats()[:2]
+	for dirname in dirs:
+		mc.get_icon_sys(dirname)
+		mc.dir_size(dirname)
+	(hits2, misses2) = mc.buffer_pool.stats()[:2]
+	hits = hits2 - hits
+	total = hits + misses2 - misses
+	if total == 0:
+		return 100.0
+	return hits * 100.0 / total
+
+def _scan_card(mc):
+	"""Read every file on the card once, returning the bytes read.
+
+	Files are read a cluster at a time so every cluster goes through
+	the buffer pool."""
+	
+	total = 0
+	buf = bytearray(mc.cluster_size)
+	mc.buffer_pool.begin_scan()
+	try:
+		for dirname in mc.glob("/*"):
+			if not mode_is_dir(mc.get_mode(dirname)):
+				continue
+			for filename in mc.glob(dirname + "/*"):
+				if not mode_is_file(mc.get_mode(filename)):
+					continue
+				f = mc.open(filename, "rb")
+				try:
+					while True:
+						n = f.readinto(buf)
+						if n == 0:
+							break
+						total += n
+				finally:
+					f.close()
+	finally:
+		mc.buffer_pool.end_scan()
+	return total
+
+def do_cache_bench(cmd, mcname, opts, args, opterr):
+	if len(args) != 0:
+		opterr("Incorrect number of arguments.")
+	for (name, policy) in [("LRU", ps2mc.PS2MC_CACHE_LRU),
+			       ("2Q", ps2mc.PS2MC_CACHE_2Q)]:
+		f = file(mcname, "rb")
+		mc = None
+		try:
+			mc = ps2mc.ps2mc(f, flat_fat = True,
+					 cache_size = opts.cache_size * 1024,
+					 cache_policy = policy)
+			dirs = [dirname for dirname in mc.glob("/*")
+				if mode_is_dir(mc.get_mode(dirname))]
+			dirs = dirs[:opts.hot_dirs]
+			_hot_pass(mc, dirs)
+			before = _hot_pass(mc, dirs)
+			length = _scan_card(mc)
+			after = _hot_pass(mc, dirs)
+			print ("%-3s  hot set hit rate %5.1f%% before and"
+			       " %5.1f%% after a %d KB scan"
+			       % (name, before, after, length / 1024))
+		finally:
+			if mc != None:
+				mc.close()
+			f.close()
+		
+def do_ecc_bench(cmd, mcname, opts, args, opterr):
+	if len(args) != 0:
+		opterr("Incorrect number of arguments.")
+	page_size = ps2mc.PS2MC_STANDARD_PAGE_SIZE
+	spare_size = page_size / 128 * 4
+	pages = os.urandom(opts.size * 1024)
+	ecc_size = page_size / 128 * 3
+	pad = "\0" * (spare_size - ecc_size)
+	old = ps2mc_ecc.ecc_get_backend()
+
+	# the results of every backend are compared with pure Python's
+	def results():
+		chunk = array.array('B', pages[:128])
+		ecc = ps2mc_ecc.ecc_calculate(chunk)
+		chunk[5] ^= 0x10
+		status = ps2mc_ecc.ecc_check(chunk, ecc)
+		bad = bytearray(pages[:page_size])
+		bad[5] ^= 0x10
+		return (ps2mc_ecc.ecc_calculate_pages(pages, page_size),
+			ecc, status, chunk,
+			ps2mc_ecc.ecc_check_pages(str(bad),
+						  spares[:spare_size],
+						  page_size))
+
+	ret = 0
+	try:
+		ps2mc_ecc.ecc_set_backend(ps2mc_ecc.ECC_BACKEND_PYTHON)
+		ecc = ps2mc_ecc.ecc_calculate_pages(pages, page_size)
+		spares = "".join([ecc[i : i + ecc_size] + pad
+				  for i in range(0, len(ecc), ecc_size)])
+		expected = results()
+		for name in ps2mc_ecc.ecc_backends():
+			ps2mc_ecc.ecc_set_backend(name)
+			start = time.time()
+			ps2mc_ecc.ecc_calculate_pages(pages, page_size)
+			calc = time.time() - start
+			start = time.time()
+			ps2mc_ecc.ecc_check_pages(pages, spares, page_size)
+			check = time.time() - start
+			print ("%-8s calculate %8.2f MB/s   check %8.2f MB/s"
+			       % (name, opts.size / 1024.0 / max(calc, 1e-6),
+				  opts.size / 1024.0 / max(check, 1e-6)))
+			if results() != expected:
+				print "%-8s results differ from python" % name
+				ret = 1
+	finally:
+		ps2mc_ecc.ecc_set_backend(old)
+	return ret
+		
 def do_print_good_blocks(cmd, mc, opts, args, opterr):
 	print "good_block2:"
 	_print_erase_block(mc, mc.good_block2)
@@ -638,6 +786,15 @@ cmd_table = {
 		  "",
 		  "Check for file system errors.",
 		  []),
+	"scan": (do_scan, "rb",
+		 "",
+		 "Check the ECC codes of every page in the image.",
+		 [opt("-j", "--jobs", type = "int", default = 1,
+		      help = "Number of processes to use.")]),
+	"scrub": (do_scrub, "rb+",
+		  "",
+		  "Rewrite pages with correctable ECC errors.",
+		  []),
 	"format": (do_format, None,
 		   "",
 		   "Creates a new memory card image.",
@@ -672,12 +829,37 @@ debug_cmd_table = {
 	"create_pad": (do_create_pad, "r+b",
 		       "",
 		       None,
-		       [])
+		       []),
+	"cache_bench": (do_cache_bench, None,
+			"",
+			None,
+			[opt("-s", "--cache-size", type = "int", metavar = "KB",
+			     default = ps2mc.PS2MC_CACHE_SIZE / 1024,
+			     help = "Buffer pool size."),
+			 opt("-n", "--hot-dirs", type = "int", metavar = "N",
+			     default = 4,
+			     help = "Number of saves in the hot set.")]),
+	"ecc_bench": (do_ecc_bench, None,
+		      "",
+		      None,
+		      [opt("-s", "--size", type = "int", metavar = "KB",
+			   default = 1024,
+			   help = "Amount of random page data to use.")])
 }
 
 del opt		# clean up name space
 
 
+def write_io_stats(mc):
+	(hits, misses, evictions, writebacks) = mc.buffer_pool.stats()
+	sys.stderr.write("buffer pool: %d hits, %d misses, %d evictions,"
+			 " %d writebacks\n"
+			 % (hits, misses, evictions, writebacks))
+	sys.stderr.write("readahead: %d clusters used, %d wasted\n"
+			 % (mc.readahead_hits, mc.readahead_waste))
+	sys.stderr.write("flush: %d write calls saved by merging"
+			 " adjacent clusters\n" % mc.write_calls_saved)
+
 def write_error(filename, msg):
 	if filename == None:
 		sys.stderr.write(msg + "\n")
@@ -733,6 +915,27 @@ def main():
 			     default = False, help = optparse.SUPPRESS_HELP)
 	optparser.add_option("-i", "--ignore-ecc", action = "store_true",
 			     help = "Ignore ECC errors while reading.")
+	optparser.add_option("--readahead", type = "int", metavar = "N",
+			     help = "Read ahead N clusters when reading"
+			     " sequentially.")
+	optparser.add_option("--cache-size", type = "int", metavar = "KB",
+			     default = ps2mc.PS2MC_CACHE_SIZE / 1024,
+			     help = "Use at most KB kilobytes for caching"
+			     " the memory card image.")
+	optparser.add_option("--storage", type = "choice",
+			     choices = ps2mc.PS2MC_STORAGE_NAMES,
+			     default = ps2mc.PS2MC_STORAGE_AUTO,
+			     help = "How to access the image file: "
+			     + ", ".join(ps2mc.PS2MC_STORAGE_NAMES)
+			     + " (default %default).")
+	optparser.add_option("--ecc-backend", type = "choice",
+			     choices = ps2mc_ecc.ecc_backends(),
+			     help = "Calculate ECC codes using: "
+			     + ", ".join(ps2mc_ecc.ecc_backends()) + ".")
+	optparser.add_option("--io-stats", action = "store_true",
+			     default = False,
+			     help = "Print caching and I/O statistics"
+			     " when done.")
 			     
 	optparser.disable_interspersed_args()
 	(opts, args) = optparser.parse_args()
@@ -750,6 +953,9 @@ def main():
 	if len(args) < 2:
 		optparser.error("Incorrect number of arguments.")
 
+	if opts.ecc_backend != None:
+		ps2mc_ecc.ecc_set_backend(opts.ecc_backend)
+
 	if opts.debug:
 		cmd_table.update(debug_cmd_table)
 	cmd = args[1]
@@ -781,9 +987,18 @@ def main():
 					 subopt_parser.error)
 			else:
 				f = file(mcname, mode)
-				mc = ps2mc.ps2mc(f, opts.ignore_ecc)
+				mc = ps2mc.ps2mc(f, opts.ignore_ecc,
+						 flat_fat = True,
+						 cache_size
+						 = opts.cache_size * 1024,
+						 storage = opts.storage)
+				if opts.readahead != None:
+					mc.readahead = opts.readahead
 				ret = fn(cmd, mc, subopts, subargs,
 					 subopt_parser.error)
+				if opts.io_stats:
+					mc.flush()
+					write_io_stats(mc)
 		finally:
 			if mc != None:
 				mc.close()
@@ -15,11 +15,16 @@ import struct
 from errno import EACCES, ENOENT, EEXIST, ENOTDIR, EISDIR, EROFS, ENOTEMPTY,\
      ENOSPC, EIO, EBUSY, EINVAL
 import fnmatch
+import collections
+import heapq
+import StringIO
+import time
 import traceback
 
 from round import *
 from ps2mc_ecc import *
 from ps2mc_dir import *
+from ps2mc_storage import *
 import ps2save
 
 PS2MC_MAGIC = "Sony PS2 Memory Card Format "
@@ -31,6 +36,35 @@ PS2MC_MAX_INDIRECT_FAT_CLUSTERS = 32
 PS2MC_CLUSTER_SIZE = 1024
 PS2MC_INDIRECT_FAT_OFFSET = 0x2000
 
+PS2MC_ALLOC_NEXT_FIT = 0
+PS2MC_ALLOC_BEST_FIT = 1
+
+# default memory budget in bytes for the buffer pool
+PS2MC_CACHE_SIZE = 80 * 1024
+
+# number of erase blocks checked at a time by scan()
+PS2MC_SCAN_BLOCKS = 64
+
+# number of erase blocks written at a time by format()
+PS2MC_FORMAT_BLOCKS = 64
+
+# buffer pool replacement policies
+PS2MC_CACHE_LRU = 0
+PS2MC_CACHE_2Q = 1
+
+# number of clusters to read ahead when a file is read sequentially
+PS2MC_READAHEAD = 8
+
+# fraction of the cache budget the dentry cache can use
+PS2MC_DENTRY_CACHE_SHARE = 0.5
+
+# bytes the dentry cache counts for each decoded entry, name and index
+# slot it keeps, on top of the raw bytes of the entries
+PS2MC_DENTRY_OVERHEAD = 128
+
+# maximum number of directories indexed by the dentry cache
+PS2MC_DIR_INDEX_LIMIT = 64
+
 PS2MC_STANDARD_PAGE_SIZE = 512
 PS2MC_STANDARD_PAGES_PER_CARD = 16384
 PS2MC_STANDARD_PAGES_PER_ERASE_BLOCK = 16
@@ -71,7 +105,7 @@ class corrupt(io_error):
 	def __init__(self, msg, f = None):
 		filename = None
 		if f != None:
-			filename = getattr(f, "name")
+			filename = getattr(f, "name", None)
 		io_error.__init__(self, EIO, msg, filename)
 		
 class ecc_error(corrupt):
@@ -115,6 +149,10 @@ def pack_superblock(sb):
 unpack_fat = unpack_32bit_array
 pack_fat = pack_32bit_array
 
+# Maps the most significant byte of a packed FAT entry to 1 if the
+# entry is free and 0 if it's allocated.
+_free_map_trans = "".join([chr(int(i < 0x80)) for i in range(256)])
+
 def pathname_split(pathname):
 	if pathname == "":
 		return (None, False, False)
@@ -124,144 +162,641 @@ def pathname_split(pathname):
 		 if name != ""],
 		components[0] != "",
 		components[-1] == "")
+
+def _glob_is_literal(pattern):
+	"""Return true if pattern doesn't contain any wildcards."""
+	
+	return "*" not in pattern and "?" not in pattern and "[" not in pattern
 		
-class lru_cache(object):
-	def __init__(self, length):
-		self._lru_list = [[i - 1, None, None, i + 1]
-				  for i in range(length + 1)]
+def _split_raw_pages(raw, page_size, raw_page_size):
+	"""Split raw pages into the tuple (data, spares)."""
+	
+	pages = "".join([raw[off : off + page_size]
+			 for off in range(0, len(raw), raw_page_size)])
+	spares = "".join([raw[off + page_size : off + raw_page_size]
+			  for off in range(0, len(raw), raw_page_size)])
+	return (pages, spares)
+
+def _erased_raw_pages(raw, raw_page_size):
+	"""Return the set of the indexes of the erased raw pages.
+
+	An erased page has both its data and spare area set to all
+	ones, so its ECC codes don't match its data."""
+	
+	erased = "\xFF" * raw_page_size
+	return set([i
+		    for i in range(len(raw) / raw_page_size)
+		    if raw[i * raw_page_size
+			   : (i + 1) * raw_page_size] == erased])
+
+def _scan_raw_pages(raw, page_size, raw_page_size, first_page):
+	"""Check the ECC of raw pages read from an image.
+
+	Returns the tuple (clean, erased, corrected, failed) giving
+	the number of clean and erased pages and lists of the corrected
+	and uncorrectable pages."""
+	
+	(pages, spares) = _split_raw_pages(raw, page_size, raw_page_size)
+	status = ecc_check_pages(pages, spares, page_size)[0]
+	erased = _erased_raw_pages(raw, raw_page_size)
+	corrected = []
+	failed = []
+	for i in range(len(status)):
+		if i in erased:
+			continue
+		if status[i] == ECC_CHECK_CORRECTED:
+			corrected.append(first_page + i)
+		elif status[i] == ECC_CHECK_FAILED:
+			failed.append(first_page + i)
+	return (len(status) - len(erased) - len(corrected) - len(failed),
+		len(erased), corrected, failed)
+
+def _scan_file_range(args):
+	"""Process pool worker for ps2mc.scan()."""
+	
+	(filename, first_page, count, page_size, raw_page_size) = args
+	f = open(filename, "rb")
+	try:
+		f.seek(first_page * raw_page_size)
+		raw = f.read(count * raw_page_size)
+	finally:
+		f.close()
+	return (len(raw),
+		_scan_raw_pages(raw, page_size, raw_page_size, first_page))
+
+class buffer_pool(object):
+	"""A cache of card clusters with a limit on the memory it uses.
+
+	With the default PS2MC_CACHE_2Q policy buffers are managed using
+	the 2Q algorithm so a pass over the whole card doesn't flush out
+	the buffers that are in regular use.  Buffers read for the first
+	time go in a FIFO queue that's limited to a quarter of the budget.
+	Buffers read again while in the queue are moved to the main LRU
+	list.  When buffers are discarded from the queue their keys are
+	remembered for a while, and buffers read again after that go
+	straight in the main list.  Buffers added by readahead aren't
+	counted as read until they're used.  Between begin_scan() and
+	end_scan() buffers are never moved to the main list or
+	remembered, so a pass over the whole card that reads some
+	clusters more than once doesn't push out the buffers in regular
+	use.  With PS2MC_CACHE_LRU all buffers go in the LRU list.
+
+	Each queue is a circular doubly linked list, most recent first,
+	with a dictionary mapping cluster numbers to list nodes, so all
+	operations take constant time.  When the total size of the
+	buffers would go over the budget, the oldest buffers that aren't
+	pinned are discarded, calling evict(key, value, dirty) for each
+	so dirty buffers can be written back.  Pinned buffers are never
+	discarded, so only they can take the pool over its budget."""
+	
+	def __init__(self, budget, evict, policy = PS2MC_CACHE_2Q):
+		self.budget = budget
+		self.policy = policy
+		self.used = 0
+		self._evict = evict
+		# nodes are [prev, next, key, value, size, pins, head, read]
+		self._in_head = self._new_head()
+		self._main_head = self._new_head()
+		self._in_used = 0
+		self._in_budget = budget / 4
+		self._ghosts = collections.OrderedDict()
+		self._ghost_used = 0
+		self._ghost_budget = budget / 2
+		self._scanning = 0
 		self._index_map = {}
+		self._dirty = set()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.writebacks = 0
+		self.reserved = 0
+
+	def _new_head(self):
+		head = [None, None, None, None, 0, 0, None, False]
+		head[0] = head[1] = head
+		return head
 
 	def dump(self):
-		lru_list = self._lru_list
-		i = 0
-		while i != len(self._lru_list):
-			print "%d: %s, " % (i, str(lru_list[i][1])), 
-			i = lru_list[i][3]
-		print
-		print self._index_map
-			
-	def _move_to_front(self, i):
-		lru_list = self._lru_list
-		first = lru_list[0]
-		i2 = first[3]
-		if i != i2:
-			elt = lru_list[i]
-			prev = lru_list[elt[0]]
-			next = lru_list[elt[3]]
-			prev[3] = elt[3]
-			next[0] = elt[0]
-			elt[0] = 0
-			elt[3] = i2
-			lru_list[i2][0] = i
-			first[3] = i
-		
-	def add(self, key, value):
-		lru_list = self._lru_list
+		for head in [self._in_head, self._main_head]:
+			elt = head[1]
+			while elt is not head:
+				print "%s%s%s, " % (str(elt[2]),
+						    ["", "*"][elt[2]
+							      in self._dirty],
+						    ["", "+"][elt[5] > 0]),
+				elt = elt[1]
+			print
+		print "%d/%d bytes" % (self.used, self.budget)
+
+	def _unlink(self, elt):
+		elt[0][1] = elt[1]
+		elt[1][0] = elt[0]
+		if elt[6] is self._in_head:
+			self._in_used -= elt[4]
+
+	def _link_front(self, elt, head):
+		first = head[1]
+		elt[0] = head
+		elt[1] = first
+		elt[6] = head
+		first[0] = elt
+		head[1] = elt
+		if head is self._in_head:
+			self._in_used += elt[4]
+
+	def _victim(self, head):
+		elt = head[0]
+		while elt is not head and elt[5] != 0:
+			elt = elt[0]
+		if elt is head:
+			return None
+		return elt
+
+	def _remember(self, key, size):
+		ghosts = self._ghosts
+		ghosts[key] = size
+		self._ghost_used += size
+		while self._ghost_used > self._ghost_budget and ghosts:
+			self._ghost_used -= ghosts.popitem(False)[1]
+
+	def _shrink(self, need):
+		"""Discard buffers until need more bytes fit in the budget."""
+		
+		in_head = self._in_head
+		main_head = self._main_head
+		while self.used + need > self.budget:
+			if self._in_used > self._in_budget:
+				elt = (self._victim(in_head)
+				       or self._victim(main_head))
+			else:
+				elt = (self._victim(main_head)
+				       or self._victim(in_head))
+			if elt == None:
+				break
+			key = elt[2]
+			if elt[6] is in_head and elt[7]:
+				self._remember(key, elt[4])
+			self._unlink(elt)
+			del self._index_map[key]
+			self.used -= elt[4]
+			dirty = key in self._dirty
+			if dirty:
+				self._dirty.remove(key)
+				self.writebacks += 1
+			self.evictions += 1
+			self._evict(key, elt[3], dirty)
+
+	def add(self, key, value, dirty = False, prefetch = False):
+		"""Add or replace a buffer.
+
+		A new buffer counts as having been read unless prefetch
+		is true."""
+		
+		size = len(value) * getattr(value, "itemsize", 1)
 		index_map = self._index_map
-		ret = None
-		if key in index_map:
-			i = index_map[key]
-			# print "add hit ", key, i
-			elt = lru_list[i]
+		elt = index_map.get(key)
+		if elt != None:
+			head = elt[6]
+			self._unlink(elt)
+			self.used -= elt[4]
+			elt[3] = value
+			elt[4] = size
 		else:
-			# print "add miss", key
-			i = lru_list[-1][0]
-			elt = lru_list[i]
-			old_key = elt[1]
-			if old_key != None:
-				del index_map[old_key]
-				ret = (old_key, elt[2])
-			index_map[key] = i
-			elt[1] = key
-		elt[2] = value
-		self._move_to_front(i)
-
-		return ret
+			scanning = self._scanning > 0
+			elt = [None, None, key, value, size, 0, None,
+			       not (prefetch or scanning)]
+			head = self._in_head
+			if self.policy == PS2MC_CACHE_LRU:
+				head = self._main_head
+			elif key in self._ghosts and not scanning:
+				self._ghost_used -= self._ghosts.pop(key)
+				head = self._main_head
+		self._shrink(size)
+		index_map[key] = elt
+		self._link_front(elt, head)
+		self.used += size
+		if dirty:
+			self._dirty.add(key)
+		else:
+			self._dirty.discard(key)
 		
 	def get(self, key, default = None):
-		i = self._index_map.get(key)
-		if i == None:
-			# print "get miss", key
+		elt = self._index_map.get(key)
+		if elt == None:
+			self.misses += 1
 			return default
-		# print "get hit ", key, i
-		ret = self._lru_list[i][2]
-		self._move_to_front(i)
-		return ret
+		self.hits += 1
+		head = self._main_head
+		if elt[6] is head:
+			if head[1] is not elt:
+				self._unlink(elt)
+				self._link_front(elt, head)
+		elif self._scanning > 0:
+			pass
+		elif elt[7]:
+			self._unlink(elt)
+			self._link_front(elt, head)
+		else:
+			elt[7] = True
+		return elt[3]
+
+	def begin_scan(self):
+		"""Start a pass over the whole card.
+
+		Calls nest and each must be matched by a call to
+		end_scan()."""
+		
+		self._scanning += 1
+
+	def end_scan(self):
+		self._scanning -= 1
+
+	def discard(self, key):
+		"""Remove a buffer without writing it back."""
+		
+		elt = self._index_map.pop(key, None)
+		if elt != None:
+			self._unlink(elt)
+			self.used -= elt[4]
+			self._dirty.discard(key)
+
+	def reserve(self, size):
+		"""Count size bytes used outside the pool against its budget.
+
+		Buffers are discarded to make room.  A negative size
+		gives back memory reserved earlier."""
+		
+		self.used += size
+		self.reserved += size
+		if size > 0 and self.used > self.budget:
+			self._shrink(0)
+
+	def pin(self, key):
+		"""Keep a buffer from being discarded until it's unpinned.
+
+		Pins nest.  Returns False if the buffer isn't in the pool."""
+		
+		elt = self._index_map.get(key)
+		if elt == None:
+			return False
+		elt[5] += 1
+		return True
+
+	def unpin(self, key):
+		elt = self._index_map.get(key)
+		if elt == None or elt[5] == 0:
+			return
+		elt[5] -= 1
+		if elt[5] == 0 and self.used > self.budget:
+			self._shrink(0)
+
+	def __contains__(self, key):
+		return key in self._index_map
+
+	def __len__(self):
+		return len(self._index_map)
 
 	def items(self):
-		return [(elt[1], elt[2])
-			for elt in self._lru_list[1 : -1]
-			if elt[2] != None]
+		"""Return a list of (key, value) pairs, most recent first."""
+		
+		ret = []
+		for head in [self._main_head, self._in_head]:
+			elt = head[1]
+			while elt is not head:
+				ret.append((elt[2], elt[3]))
+				elt = elt[1]
+		return ret
+
+	def dirty_items(self):
+		"""Return a list of the dirty (key, value) pairs sorted by key."""
+		
+		index_map = self._index_map
+		return [(key, index_map[key][3])
+			for key in sorted(self._dirty)]
+
+	def mark_clean(self, key):
+		"""Mark a dirty buffer as having been written back."""
+		
+		if key in self._dirty:
+			self._dirty.remove(key)
+			self.writebacks += 1
+
+	def stats(self):
+		"""Return the tuple (hits, misses, evictions, writebacks)."""
+		
+		return (self.hits, self.misses, self.evictions,
+			self.writebacks)
+
+class directory_index(object):
+	"""An index of the names and free slots of a directory.
+
+	Built from the list of all the entries in the directory and
+	kept current by passing every entry written to update()."""
+
+	def __init__(self, ents):
+		self.length = 0
+		self.names = {}
+		self._slot_names = {}
+		self._in_use = 0
+		self._free = set()
+		self._free_heap = []
+		for i in range(len(ents)):
+			self.update(i, ents[i])
+
+	def _set_free(self, index):
+		if index not in self._free:
+			self._free.add(index)
+			heapq.heappush(self._free_heap, index)
+
+	def update(self, index, ent):
+		for i in range(self.length, index):
+			self._set_free(i)
+		self.length = max(self.length, index + 1)
+		
+		name = self._slot_names.pop(index, None)
+		if name != None:
+			if index >= 2:
+				self._in_use -= 1
+			if self.names.get(name) == index:
+				del self.names[name]
+		if ent[0] & DF_EXISTS:
+			self._free.discard(index)
+			self._slot_names[index] = ent[8]
+			self.names.setdefault(ent[8], index)
+			if index >= 2:
+				self._in_use += 1
+		else:
+			self._set_free(index)
+
+	def find(self, name):
+		"""Return the index of the entry called name or None."""
+		
+		return self.names.get(name)
+
+	def first_free(self):
+		"""Return the index of the first unused entry.
+
+		If there isn't one, the index just past the end of the
+		directory is returned."""
+		
+		heap = self._free_heap
+		while len(heap) > 0 and heap[0] not in self._free:
+			heapq.heappop(heap)
+		if len(heap) == 0:
+			return self.length
+		return heap[0]
+
+	def is_empty(self):
+		"""Return true if only the "." and ".." entries are used."""
+		
+		return self._in_use == 0
+
+class dentry_cache(object):
+	"""A cache of unpacked directory entries.
+
+	Entries are looked up by their dirloc, and the dirlocs of
+	entries by the first cluster of their directory and their name.
+	Names known not to exist in a directory are remembered as
+	well.  Writes to directory entries must be passed to update()
+	so the cache stays consistent with the image.
+
+	A directory_index of each recently searched directory is kept
+	as well.
+
+	The memory used is estimated in bytes, counting each entry as
+	its raw size plus PS2MC_DENTRY_OVERHEAD and each name and
+	directory_index slot as PS2MC_DENTRY_OVERHEAD.  It's reserved
+	in the buffer pool so it counts against the pool's budget.  If
+	the entries and names would take the cache past its limit they
+	are simply emptied, and the same is done with the indexes."""
+
+	def __init__(self, pool, limit):
+		self.pool = pool
+		self.limit = limit
+		self._ents = {}
+		self._names = {}
+		self._dirs = {}
+		self._ent_used = 0
+		self._dir_used = {}
+		self._dir_total = 0
+		self.hits = 0
+		self.misses = 0
+
+	def _charge(self, size):
+		self._ent_used += size
+		self.pool.reserve(size)
+
+	def clear(self):
+		self._ents.clear()
+		self._names.clear()
+		self._charge(-self._ent_used)
+		self._clear_dirs()
+
+	def _clear_dirs(self):
+		self.pool.reserve(-self._dir_total)
+		self._dirs.clear()
+		self._dir_used.clear()
+		self._dir_total = 0
+
+	def _make_room(self, size):
+		if self._ent_used + self._dir_total + size > self.limit:
+			self._ents.clear()
+			self._names.clear()
+			self._charge(-self._ent_used)
+
+	def _set_ent(self, dirloc, ent):
+		if dirloc not in self._ents:
+			size = PS2MC_DIRENT_LENGTH + PS2MC_DENTRY_OVERHEAD
+			self._make_room(size)
+			self._charge(size)
+		self._ents[dirloc] = copy_dirent(ent)
+
+	def _set_name(self, key, index):
+		if key not in self._names:
+			self._make_room(PS2MC_DENTRY_OVERHEAD)
+			self._charge(PS2MC_DENTRY_OVERHEAD)
+		self._names[key] = index
+
+	def _del_name(self, key):
+		del self._names[key]
+		self._charge(-PS2MC_DENTRY_OVERHEAD)
+
+	def _charge_dir(self, dir_cluster, index):
+		size = index.length * PS2MC_DENTRY_OVERHEAD
+		change = size - self._dir_used.get(dir_cluster, 0)
+		if change != 0:
+			self.pool.reserve(change)
+			self._dir_used[dir_cluster] = size
+			self._dir_total += change
+
+	def get_dir(self, dir_cluster):
+		"""Return the directory_index of a directory or None."""
+		
+		return self._dirs.get(dir_cluster)
+
+	def add_dir(self, dir_cluster, ents):
+		"""Index the list of entries of the directory starting at
+		dir_cluster, returning the new directory_index."""
+		
+		if (len(self._dirs) >= PS2MC_DIR_INDEX_LIMIT
+		    or (self._ent_used + self._dir_total
+			+ len(ents) * PS2MC_DENTRY_OVERHEAD > self.limit)):
+			self._clear_dirs()
+		index = directory_index(ents)
+		self._dirs[dir_cluster] = index
+		self._charge_dir(dir_cluster, index)
+		return index
+
+	def get(self, dirloc):
+		"""Return a copy of the cached entry for dirloc or None."""
+		
+		ent = self._ents.get(dirloc)
+		if ent == None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return copy_dirent(ent)
+
+	def add(self, dirloc, ent):
+		self._set_ent(dirloc, ent)
+
+	def find(self, dir_cluster, name):
+		"""Look up a name in the directory starting at dir_cluster.
+
+		Returns the tuple (hit, index) where hit is false if
+		nothing is known about the name, otherwise index is
+		the index of the entry or None if it doesn't exist."""
+		
+		key = (dir_cluster, name)
+		if key not in self._names:
+			self.misses += 1
+			return (False, None)
+		self.hits += 1
+		return (True, self._names[key])
+
+	def add_name(self, dir_cluster, name, index, ent):
+		"""Remember the result of searching a directory for name.
+
+		If the name wasn't found index and ent should be None."""
+		
+		self._set_name((dir_cluster, name), index)
+		if index != None:
+			self._set_ent((dir_cluster, index), ent)
+
+	def update(self, dirloc, ent):
+		"""Record that the entry at dirloc was written."""
 		
+		old = self._ents.get(dirloc)
+		if old != None:
+			key = (dirloc[0], old[8])
+			if self._names.get(key) == dirloc[1]:
+				self._del_name(key)
+		self._set_ent(dirloc, ent)
+		key = (dirloc[0], ent[8])
+		if ent[0] & DF_EXISTS:
+			self._set_name(key, dirloc[1])
+		elif self._names.get(key, None) == dirloc[1]:
+			self._del_name(key)
+		index = self._dirs.get(dirloc[0])
+		if index != None:
+			index.update(dirloc[1], ent)
+			self._charge_dir(dirloc[0], index)
+		
+# A file or directory in a card_snapshot.  dirent is the directory entry
+# as a tuple, size the number of clusters used, including those used by
+# the contents of a directory, chain the tuple of clusters the file or
+# directory itself occupies and entries a tuple of the snapshot_entry
+# objects of everything in a directory, or None for anything else.
+snapshot_entry = collections.namedtuple("snapshot_entry",
+					["name", "dirent", "dirloc", "size",
+					 "chain", "entries"])
+
+# A top level directory in a card_snapshot.  icon_sys is the contents
+# of a valid icon.sys file and psx_header the first 128 bytes of the
+# file with the same name as the directory, both None if missing.
+snapshot_save = collections.namedtuple("snapshot_save",
+				       ["entry", "icon_sys", "psx_header"])
+
+class card_snapshot(collections.namedtuple("card_snapshot",
+					   ["root", "saves", "cluster_size",
+					    "free_clusters",
+					    "allocatable_clusters"])):
+	"""The metadata of a whole memory card, as returned by
+	ps2mc.snapshot()."""
+
+	__slots__ = ()
+
+	def find(self, dirloc):
+		"""Return the snapshot_entry with the given dirloc or None."""
+		
+		pending = [self.root]
+		while len(pending) > 0:
+			entry = pending.pop()
+			if entry.dirloc == dirloc:
+				return entry
+			if entry.entries != None:
+				pending += entry.entries
+		return None
+
 class fat_chain(object):
-	"""A class for accessing a file's FAT entries as a simple sequence."""
+	"""A class for accessing a file's FAT entries as a simple sequence.
+
+	The cluster numbers found while walking the chain are remembered,
+	so looking up a cluster only walks the part of the chain that
+	hasn't been seen yet."""
 	
 	def __init__(self, lookup_fat, first):
 		self.lookup_fat = lookup_fat
-		self._first = first
-		self.offset = 0
-		self._prev = None
-		self._cur = first
-
-	def __getitem__(self, i):
-		# not iterable
-		offset = self.offset
-		if i == offset:
-			# print "@@@ fat_chain[] cur:", i, self._cur
-			return self._cur
-		elif i == offset - 1:
-			assert self._prev != None
-			# print "@@@ fat_chain[] prev:", i, self._prev
-			return self._prev
-		if i < offset:
-			if i == 0:
-				# print "@@@ fat_chain[] first", i, self._first
-				return self._first
-			offset = 0
-			prev = None
-			cur = self._first
-		else:
-			prev = self._prev
-			cur = self._cur
-		# print "@@@ fat_chain[] distance", i - offset
-		while offset != i:
-			next = self.lookup_fat(cur)
+		self._clusters = array.array('I')
+		self._complete = (first == PS2MC_FAT_CHAIN_END)
+		if not self._complete:
+			self._clusters.append(first)
+
+	def _walk(self, i):
+		clusters = self._clusters
+		lookup_fat = self.lookup_fat
+		cur = clusters[-1]
+		while len(clusters) <= i:
+			next = lookup_fat(cur)
 			if next == PS2MC_FAT_CHAIN_END:
-				break;
+				self._complete = True
+				break
 			if next & PS2MC_FAT_ALLOCATED_BIT:
 				next &= ~PS2MC_FAT_ALLOCATED_BIT
 			else:
 				# corrupt
-				next = PS2MC_FAT_CHAIN_END
+				self._complete = True
 				break
-
-			offset += 1
-			prev = cur
+			clusters.append(next)
 			cur = next
-		self.offset = offset
-		self._prev = prev
-		self._cur = cur
-		# print "@@@ offset, prev, cur:", offset, prev, cur
-		# print "@@@ fat_chain[]", i, next
-		return next
+		
+	def __getitem__(self, i):
+		# not iterable
+		clusters = self._clusters
+		if i >= len(clusters):
+			if self._complete:
+				return PS2MC_FAT_CHAIN_END
+			self._walk(i)
+			if i >= len(clusters):
+				return PS2MC_FAT_CHAIN_END
+		return clusters[i]
 
 	def __len__(self):
-		old_prev = self._prev
-		old_cur = self._cur
-		old_offset = self.offset
-		i = self.offset
-		while self[i] != PS2MC_FAT_CHAIN_END:
-			i += 1
-		self._prev = old_prev
-		self._cur = old_cur
-		self.offset = old_offset
-		return i
+		if not self._complete:
+			self._walk(sys.maxint)
+		return len(self._clusters)
+
+	def extend(self, clusters):
+		"""Add clusters that have been linked to the end of the chain."""
+		
+		if self._complete:
+			self._clusters.extend(clusters)
 		
 class ps2mc_file(object):
 	"""A file-like object for accessing a file in memory card image."""
 	
 	def __init__(self, mc, dirloc, first_cluster, length, mode,
-		     name = None):
+		     name = None, write_behind = False):
 		# print "ps2mc_file.__init__", name, self
 		self.mc = mc
 		self.length = length
@@ -269,8 +804,15 @@ class ps2mc_file(object):
 		self.dirloc = dirloc
 		self.fat_chain = None
 		self._pos = 0
+		self._write_behind = write_behind
+		self._dirent_pending = False
+		self._modified_pending = False
 		self.buffer = None
 		self.buffer_cluster = None
+		self._buffer_pin = None
+		self._buffer_dirty = False
+		self._ra_next = 0
+		self._ra_end = 0
 		self.softspace = 0
 		if name == None:
 			self.name = "<ps2mc_file>"
@@ -288,6 +830,90 @@ class ps2mc_file(object):
 		elif mode[0] != "w" or ("+" not in self.mode):
 			self._write = True
 
+	def _update_dirent(self, first_cluster, length, modified):
+		"""Update the file's directory entry.
+
+		In write-behind mode the update is only recorded and other
+		handles open on the file are notified.  The directory entry
+		itself is written by flush_dirent()."""
+		
+		if not self._write_behind:
+			self.mc.update_dirent(self.dirloc, self, first_cluster,
+					      length, modified)
+			return
+		if first_cluster != None or length != None:
+			self.mc.notify_open_files(self.dirloc, self,
+						  self.first_cluster,
+						  self.length)
+			self._dirent_pending = True
+		if modified:
+			self._dirent_pending = True
+			self._modified_pending = True
+
+	def _flush_buffer(self):
+		"""Write out the cluster buffer if it has been modified."""
+		
+		if not self._buffer_dirty:
+			return
+		self._buffer_dirty = False
+		if not self.write_file_cluster(self.buffer_cluster,
+					       self.buffer):
+			raise io_error, (ENOSPC, "out of space on image",
+					 self.name)
+
+	def _set_buffer(self, n, cluster, buf):
+		"""Make buf the buffer for file cluster n.
+
+		The buffer is pinned in the buffer pool as allocatable
+		cluster cluster for as long as the file holds on to it.
+		Any modifications to the old buffer are written out first."""
+		
+		if n != self.buffer_cluster:
+			self._flush_buffer()
+		mc = self.mc
+		# pin the new buffer before unpinning the old one, as
+		# unpinning can discard buffers to get back under budget
+		pin = None
+		if cluster != None and mc.pin_allocatable_cluster(cluster):
+			pin = cluster
+		if self._buffer_pin != None:
+			mc.unpin_allocatable_cluster(self._buffer_pin)
+		self._buffer_pin = pin
+		self.buffer = buf
+		self.buffer_cluster = n
+
+	def _load_buffer(self, n):
+		"""Make the cluster buffer a modifiable copy of cluster n.
+
+		If the cluster is past the end of the file it's allocated
+		and the buffer is filled with zeros."""
+		
+		buf = self.buffer
+		if n == self.buffer_cluster and isinstance(buf, bytearray):
+			return buf
+		self._flush_buffer()
+		buf = self.read_file_cluster(n)
+		if buf == None:
+			buf = bytearray(self.mc.cluster_size)
+			if not self.write_file_cluster(n, buf):
+				raise io_error, (ENOSPC,
+						 "out of space on image",
+						 self.name)
+		elif not isinstance(buf, bytearray):
+			buf = self.buffer = bytearray(buf)
+		return buf
+
+	def flush_dirent(self):
+		"""Write any directory entry updates held back by write-behind."""
+		
+		if not self._dirent_pending or self.mc == None:
+			return
+		self._dirent_pending = False
+		modified = self._modified_pending
+		self._modified_pending = False
+		self.mc.update_dirent(self.dirloc, self, self.first_cluster,
+				      self.length, modified)
+
 	def _find_file_cluster(self, n):
 		if self.fat_chain == None:
 			self.fat_chain = self.mc.fat_chain(self.first_cluster)
@@ -300,9 +926,32 @@ class ps2mc_file(object):
 		# print "@@@ read_file_cluster", self.dirloc, n, cluster, repr(self.name)
 		if cluster == PS2MC_FAT_CHAIN_END:
 			return None
-		self.buffer = self.mc.read_allocatable_cluster(cluster)
-		self.buffer_cluster = n
-		return self.buffer 
+		if n == self._ra_next and n >= self._ra_end:
+			buf = self._readahead(n, cluster)
+		else:
+			buf = self.mc.read_allocatable_cluster(cluster)
+		self._ra_next = n + 1
+		self._set_buffer(n, cluster, buf)
+		return buf
+
+	def _readahead(self, n, cluster):
+		"""Read file cluster n along with the next clusters in the chain.
+
+		The following clusters are read into the buffer pool so the
+		sequential reads that come next don't have to go to the
+		image."""
+		
+		mc = self.mc
+		end = min(n + mc.readahead,
+			  div_round_up(self.length, mc.cluster_size))
+		clusters = [cluster]
+		for i in range(n + 1, end):
+			c = self._find_file_cluster(i)
+			if c == PS2MC_FAT_CHAIN_END:
+				break
+			clusters.append(c)
+		self._ra_end = n + len(clusters)
+		return mc.read_allocatable_cluster_ahead(clusters)
 
 	def _extend_file(self, n):
 		mc = self.mc
@@ -314,21 +963,20 @@ class ps2mc_file(object):
 			self.first_cluster = cluster
 			self.fat_chain = None
 			# print "@@@ linking", self.dirloc, "->", cluster
-			mc.update_dirent(self.dirloc, self, cluster,
-					 None, False)
+			self._update_dirent(cluster, None, False)
 		else:
-			prev = self.fat_chain[n - 1]
+			prev = self._find_file_cluster(n - 1)
 			# print "@@@ linking", prev, "->", cluster
 			mc.set_fat(prev, cluster | PS2MC_FAT_ALLOCATED_BIT)
+			self.fat_chain.extend([cluster])
 		return cluster
 	
 	def write_file_cluster(self, n, buf):
 		mc = self.mc
 		cluster = self._find_file_cluster(n)
 		if cluster != PS2MC_FAT_CHAIN_END:
-			mc.write_allocatable_cluster(cluster, buf)
-			self.buffer = buf
-			self.buffer_cluster = n
+			buf = mc.write_allocatable_cluster(cluster, buf)
+			self._set_buffer(n, cluster, buf)
 			return True
 
 		cluster_size = mc.cluster_size
@@ -344,30 +992,68 @@ class ps2mc_file(object):
 			if cluster == None:
 				if i != file_cluster_end:
 					self.length = (i - 1) * cluster_size
-					mc.update_dirent(self.dirloc, self,
-							 None, self.length,
-							 True)
+					self._update_dirent(None, self.length,
+							    True)
 				return False
 			mc.write_allocatable_cluster(cluster,
-						     ["\0"] * cluster_size)
+						     "\0" * cluster_size)
 		
 		cluster = self._extend_file(n)
 		if cluster == None:
 			return False
 
-		mc.write_allocatable_cluster(cluster, buf)
-		self.buffer = buf
-		self.buffer_cluster = n
+		buf = mc.write_allocatable_cluster(cluster, buf)
+		self._set_buffer(n, cluster, buf)
 		return True
 	
 	def update_notify(self, first_cluster, length):
-		if self.first_cluster != first_cluster:
-			self.first_cluster = first_cluster
-			self.fat_chain = None
+		self._flush_buffer()
+		self.first_cluster = first_cluster
+		self.fat_chain = None
 		self.length = length
-		self.buffer = None
-		self.buffer_cluster = None
+		self._set_buffer(None, None, None)
+		self._ra_end = 0
+		
+	def readinto(self, b):
+		"""Read up to len(b) bytes into the bytearray b.
+
+		Runs of clusters that are physically adjacent in the image
+		are read together with a single read.  Returns the number
+		of bytes read."""
 		
+		if self.closed:
+			raise ValueError, "file is closed"
+
+		self._flush_buffer()
+		mc = self.mc
+		cluster_size = mc.cluster_size
+		pos = self._pos
+		size = max(min(self.length - pos, len(b)), 0)
+		last = (pos + size - 1) / cluster_size
+		i = 0
+		while i < size:
+			n = pos / cluster_size
+			off = pos % cluster_size
+			cluster = self._find_file_cluster(n)
+			if cluster == PS2MC_FAT_CHAIN_END:
+				break
+			count = 1
+			while (n + count <= last
+			       and (self._find_file_cluster(n + count)
+				    == cluster + count)):
+				count += 1
+			if count == 1:
+				buf = self.read_file_cluster(n)
+			else:
+				buf = mc.read_allocatable_clusters(cluster, count)
+				self._ra_next = n + count
+			l = min(count * cluster_size - off, size - i)
+			b[i : i + l] = buffer(buf, off, l)
+			pos += l
+			self._pos = pos
+			i += l
+		return i
+
 	def read(self, size = None, eol = None):
 		if self.closed:
 			raise ValueError, "file is closed"
@@ -377,6 +1063,13 @@ class ps2mc_file(object):
 		if size == None:
 			size = self.length
 		size = max(min(self.length - pos, size), 0)
+		if eol == None:
+			ret = bytearray(size)
+			l = self.readinto(ret)
+			if l != size:
+				del ret[l:]
+			return str(ret)
+		
 		ret = ""
 		while size > 0:
 			off = pos % cluster_size
@@ -384,16 +1077,15 @@ class ps2mc_file(object):
 			buf = self.read_file_cluster(pos / cluster_size)
 			if buf == None:
 				break
-			if eol != None:
-				i = buf.find(eol, off, off + l)
-				if i != -1:
-					l = off - i + 1
-					size = l
+			i = buf.find(eol, off, off + l)
+			if i != -1:
+				l = i - off + 1
+				size = l
 			pos += l
 			self._pos = pos
 			ret += buf[off : off + l]
 			size -= l
-		return ret
+		return str(ret)
 
 	def write(self, out, _set_modified = True):
 		if self.closed:
@@ -416,31 +1108,132 @@ class ps2mc_file(object):
 			l = min(cluster_size - off, size)
 			s = out[i : i + l]
 			pos += l
-			if l == cluster_size:
-				buf = s
+			if l == cluster_size and cluster != self.buffer_cluster:
+				if not self.write_file_cluster(cluster, s):
+					raise io_error, (ENOSPC,
+							 "out of space on image",
+							 self.name)
 			else:
-				buf = self.read_file_cluster(cluster)
-				if buf == None:
-					buf = "\0" * cluster_size
-				buf = buf[:off] + s + buf[off + l:]
-			if not self.write_file_cluster(cluster, buf):
-				raise io_error, (ENOSPC,
-						 "out of space on image",
-						 self.name)
+				# partial cluster writes are made in place
+				# to the buffer, which is only written out
+				# when the cluster is filled or the file
+				# position moves to another cluster
+				buf = self._load_buffer(cluster)
+				buf[off : off + l] = s
+				self._buffer_dirty = True
+				# a buffer that isn't pinned in the buffer pool
+				# can't be seen by other handles, so it's
+				# written through
+				if (off + l == cluster_size
+				    or not self._write_behind
+				    or self._buffer_pin == None):
+					self._flush_buffer()
 			self._pos = pos
 			# print "@@@ pos", pos
 			new_length = None
 			if pos > self.length:
 				new_length = self.length = pos
-			self.mc.update_dirent(self.dirloc, self, None,
-					      new_length, _set_modified)
+			self._update_dirent(None, new_length, _set_modified)
 
 			i += l
 			size -= l
 
+	def write_all(self, out, _set_modified = True):
+		"""Write a string to the file in one operation.
+
+		Like write(), but all the clusters needed to extend the
+		file are allocated at once, preferably contiguously, and
+		the directory entry is only updated once."""
+		
+		if self.closed:
+			raise ValueError, "file is closed"
+	
+		mc = self.mc
+		cluster_size = mc.cluster_size
+		pos = self._pos
+		if self._append: 
+			pos = self.length
+		elif not self._write:
+			raise io_error, (EACCES, "file not opened for writing",
+					 self.name)
+
+		size = len(out)
+		if size == 0:
+			return
+		self._flush_buffer()
+		end = pos + size
+		file_cluster_end = div_round_up(self.length, cluster_size)
+		new_cluster_end = div_round_up(end, cluster_size)
+		
+		first_cluster = None
+		chain = []
+		if new_cluster_end > file_cluster_end:
+			if (self._find_file_cluster(file_cluster_end)
+			    != PS2MC_FAT_CHAIN_END
+			    or (file_cluster_end > 0
+				and self._find_file_cluster(file_cluster_end - 1)
+				== PS2MC_FAT_CHAIN_END)):
+				raise corrupt, ("file length doesn't match"
+						" cluster chain length", mc.f)
+			chain = mc.allocate_clusters(new_cluster_end
+						     - file_cluster_end)
+			if chain == None:
+				raise io_error, (ENOSPC,
+						 "out of space on image",
+						 self.name)
+			if file_cluster_end == 0:
+				first_cluster = self.first_cluster = chain[0]
+				self.fat_chain = None
+			else:
+				prev = self.fat_chain[file_cluster_end - 1]
+				mc.set_fat(prev,
+					   chain[0] | PS2MC_FAT_ALLOCATED_BIT)
+				self.fat_chain.extend(chain)
+
+		self._set_buffer(None, None, None)
+		for n in range(min(pos / cluster_size, file_cluster_end),
+			       new_cluster_end):
+			base = n * cluster_size
+			off = min(max(pos - base, 0), cluster_size)
+			s = out[max(base + off - pos, 0)
+				: max(base + cluster_size - pos, 0)]
+			if n < file_cluster_end:
+				cluster = self._find_file_cluster(n)
+				if len(s) != cluster_size:
+					buf = mc.read_allocatable_cluster(cluster)
+					s = buf[:off] + s + buf[off + len(s):]
+			else:
+				cluster = chain[n - file_cluster_end]
+				if len(s) != cluster_size:
+					s = ("\0" * off + s
+					     + "\0" * (cluster_size - off - len(s)))
+			mc.write_allocatable_cluster(cluster, s)
+
+		self._pos = end
+		new_length = None
+		if end > self.length:
+			new_length = self.length = end
+		self._update_dirent(first_cluster, new_length, _set_modified)
+
+	def flush_pending(self):
+		"""Write out any buffered data and directory entry updates."""
+		
+		if self.mc != None:
+			self._flush_buffer()
+			self.flush_dirent()
+
+	def flush(self):
+		if self.closed:
+			raise ValueError, "file is closed"
+		if self.mc != None:
+			self.flush_pending()
+			self.mc.flush()
+
 	def close(self):
 		# print "ps2mc_file.close", self.name, self
 		if self.mc != None:
+			self.flush_pending()
+			self._set_buffer(None, None, None)
 			self.mc.notify_closed(self.dirloc, self)
 			self.mc = None
 		self.fat_chain = None
@@ -469,6 +1262,8 @@ class ps2mc_file(object):
 		else:
 			base = 0
 		pos = max(base + offset, 0)
+		if pos / self.mc.cluster_size != self.buffer_cluster:
+			self._flush_buffer()
 		self._pos = pos
 
 	def tell(self):
@@ -508,9 +1303,11 @@ class ps2mc_directory(object):
 
 	def write_raw_ent(self, index, ent, set_modified):
 		# print "@@@ write_raw_ent", index
+		s = pack_dirent(ent)
 		self.seek(index)
-		self.f.write(pack_dirent(ent),
-			     _set_modified = set_modified)
+		self.f.write(s, _set_modified = set_modified)
+		self.f.mc.update_dentry((self.f.first_cluster, index),
+					unpack_dirent(s))
 
 	def next(self):
 		# print "@@@ next", self.tell(), self.f.name
@@ -524,6 +1321,17 @@ class ps2mc_directory(object):
 			raise StopIteration
 		return unpack_dirent(dirent)
 
+	def read_all(self):
+		"""Return a list of all the entries in the directory.
+
+		The directory is read with one read and the entries are
+		decoded in a single pass.  Leaves the position at the end
+		of the directory."""
+		
+		self.seek(0)
+		return unpack_dirents(self.f.read(len(self)
+						  * PS2MC_DIRENT_LENGTH))
+
 	def seek(self, offset, whence = 0):
 		self.f.seek(offset * PS2MC_DIRENT_LENGTH, whence)
 
@@ -590,7 +1398,11 @@ class ps2mc(object):
 	will remain."""
 	
 	open_files = None
-	fat_cache = None
+	buffer_pool = None
+	fat_table = None
+	free_map = None
+	storage = None
+	dentry_cache = None
 	
 	def _calculate_derived(self):
 		self.spare_size = div_round_up(self.page_size, 128) * 4
@@ -605,12 +1417,29 @@ class ps2mc(object):
 			 - self.allocatable_cluster_offset)
 		self.allocatable_cluster_limit = limit
 
-	def __init__(self, f, ignore_ecc = False, params = None):
+	def __init__(self, f, ignore_ecc = False, params = None,
+		     flat_fat = False, cache_size = PS2MC_CACHE_SIZE,
+		     cache_policy = PS2MC_CACHE_2Q,
+		     storage = PS2MC_STORAGE_AUTO):
 		self.open_files = {}
-		self.fat_cache = lru_cache(12)
-		self.alloc_cluster_cache = lru_cache(64)
+		self.buffer_pool = buffer_pool(cache_size, self._evict_buffer,
+					       cache_policy)
+		self._pinned_fat_cluster = None
+		self.readahead = PS2MC_READAHEAD
+		self.readahead_hits = 0
+		self.readahead_waste = 0
+		self.write_calls_saved = 0
+		self._readahead_pending = set()
+		self.dentry_cache = dentry_cache(self.buffer_pool,
+						 int(cache_size
+						     * PS2MC_DENTRY_CACHE_SHARE))
+		self.fat_table = None
+		self.free_map = None
+		self.alloc_policy = PS2MC_ALLOC_NEXT_FIT
+		self.write_behind = True
 		self.modified = False
 		self.f = None
+		self.storage = None
 		self.rootdir = None
 		
 		f.seek(0)
@@ -620,6 +1449,12 @@ class ps2mc(object):
 				raise corrupt, ("Not a PS2 memory card image",
 						f)
 			self.f = f
+			# the image grows while it's being formatted,
+			# which only these two storage types allow
+			if storage == PS2MC_STORAGE_MEMORY:
+				self.storage = memory_storage(f)
+			else:
+				self.storage = file_storage(f)
 			self.format(params)
 		else:
 			sb = unpack_superblock(s)
@@ -639,6 +1474,7 @@ class ps2mc(object):
 			self._calculate_derived()
 
 			self.f = f
+			self.storage = open_storage(f, storage)
 			self.ignore_ecc = False
 
 			try:
@@ -660,9 +1496,12 @@ class ps2mc(object):
 		    or not mode_is_dir(dot[0]) or not mode_is_dir(dotdot[0])):
 			raise corrupt, "Root directory damaged."
 		
-		self.fat_cursor = 0
 		self.curdir = (0, 0)
 
+		if flat_fat:
+			self._load_fat_table()
+		self._build_free_map()
+
 	def write_superblock(self):
 		s = pack_superblock((PS2MC_MAGIC,
 				     self.version,
@@ -684,10 +1523,9 @@ class ps2mc(object):
 		self.write_page(0, s)
 
 		page = "\xFF" * self.raw_page_size
-		self.f.seek(self.good_block2 * self.pages_per_erase_block
-			    * self.raw_page_size)
-		for i in range(self.pages_per_erase_block):
-			self.f.write(page)
+		self.storage.write(self.good_block2 * self.pages_per_erase_block
+				   * self.raw_page_size,
+				   page * self.pages_per_erase_block)
 
 		self.modified = False
 		return
@@ -765,19 +1603,29 @@ class ps2mc(object):
 		erased = "\0" * page_size
 		if not with_ecc:
 			self.spare_size = 0
+			self.raw_page_size = page_size
 		else:
 			ecc = "".join(["".join(map(chr, s))
 				       for s in ecc_calculate_page(erased)])
 			erased += ecc + "\0" * (self.spare_size - len(ecc))
 
-		self.f.seek(0)
-		for page in range(pages_per_card):
-			self.f.write(erased)
+		# erase the image a group of erase blocks at a time
+		storage = self.storage
+		step = pages_per_erase_block * PS2MC_FORMAT_BLOCKS
+		chunk = erased * step
+		for page in range(0, pages_per_card, step):
+			count = min(step, pages_per_card - page)
+			if count != step:
+				chunk = erased * count
+			storage.write(page * len(erased), chunk)
 
 		self.modified = True
 		
+		# build the indirect FAT and FAT clusters in memory,
+		# they're consecutive so they can be written together
 		first_fat_cluster = first_ifc + indirect_fat_clusters
 		remainder = fat_clusters % epc
+		bufs = []
 		for i in range(indirect_fat_clusters):
 			base = first_fat_cluster + i * epc
 			buf = unpack_fat(range(base, base + epc))
@@ -785,16 +1633,25 @@ class ps2mc(object):
 			    and remainder != 0):
 				del buf[remainder:]
 				buf.fromlist([0xFFFFFFFF] * (epc - remainder))
-			self._write_fat_cluster(ifc_list[i], buf)
-
-		
-		# go through the fat backwards for better cache usage
-		for i in range(allocatable_clusters - 1,
-			       allocatable_cluster_end - 1, -1):
-			self.set_fat(i, PS2MC_FAT_CHAIN_END)
-		for i in range(allocatable_cluster_end - 1, 0, -1):
-			self.set_fat(i, PS2MC_FAT_CLUSTER_MASK)
-		self.set_fat(0, PS2MC_FAT_CHAIN_END)
+			bufs.append(pack_fat(buf))
+		fat = unpack_fat([PS2MC_FAT_CHAIN_END])
+		fat.fromlist([PS2MC_FAT_CLUSTER_MASK]
+			     * (allocatable_cluster_end - 1))
+		fat.fromlist([PS2MC_FAT_CHAIN_END]
+			     * (allocatable_clusters
+				- allocatable_cluster_end))
+		for i in range(fat_clusters):
+			bufs.append(pack_fat(fat[i * epc : i * epc + epc]))
+
+		# most FAT clusters are the same, only make
+		# each raw cluster with its ECC codes once
+		made = {}
+		raw = []
+		for buf in bufs:
+			if buf not in made:
+				made[buf] = self.make_raw_clusters([buf])
+			raw.append(made[buf])
+		self.write_raw_clusters(first_ifc, bytearray().join(raw))
 
 		self.allocatable_cluster_end = allocatable_cluster_end
 		
@@ -815,127 +1672,377 @@ class ps2mc(object):
 
 	def read_page(self, n):
 		# print "@@@ page", n
-		f = self.f
-		f.seek(self.raw_page_size * n)
-		page = f.read(self.page_size)
-		if len(page) != self.page_size:
-			raise corrupt, ("attempted to read past EOF"
-					" (page %05X)" % n, f)
+		page_size = self.page_size
 		if self.ignore_ecc:
-			return page
-		spare = f.read(self.spare_size)
-		if len(spare) != self.spare_size:
+			size = page_size
+		else:
+			size = self.raw_page_size
+		raw = self.storage.read(self.raw_page_size * n, size)
+		if len(raw) != size:
 			raise corrupt, ("attempted to read past EOF"
-					" (page %05X)" % n, f)
-		(status, page, spare) = ecc_check_page(page, spare)
+					" (page %05X)" % n, self.f)
+		if self.ignore_ecc:
+			return raw
+		(status, page, spare) = ecc_check_page(raw[:page_size],
+						       raw[page_size:])
 		if status == ECC_CHECK_FAILED:
 			raise ecc_error, ("Unrecoverable ECC error (page %d)"
 					  % n)
 		return page
 
 	def write_page(self, n, buf):
-		f = self.f
-		f.seek(self.raw_page_size * n)
 		self.modified = True
 		if len(buf) != self.page_size:
 			raise error, ("internal error: write_page:"
 				      " %d != %d" % (len(buf), self.page_size))
-		f.write(buf)
 		if self.spare_size != 0:
-			a = array.array('B')
-			for s in ecc_calculate_page(buf):
-				a.fromlist(s)
-			a.tofile(f)
-			f.write("\0" * (self.spare_size - len(a)))
+			buf = str(buf) + self._make_spare(buf)
+		self.storage.write(self.raw_page_size * n, buf)
+
+	def _make_spare(self, page):
+		ecc = ecc_calculate_pages(page, self.page_size)
+		return ecc + "\0" * (self.spare_size - len(ecc))
 			
-	def read_cluster(self, n):
-		pages_per_cluster = self.pages_per_cluster
-		cluster_size = self.cluster_size
-		if self.spare_size == 0:
-			self.f.seek(cluster_size * n)
-			return self.f.read(cluster_size)
-		n *= pages_per_cluster
-		if pages_per_cluster == 2:
-			return self.read_page(n) + self.read_page(n + 1)
-		return "".join(map(self.read_page,
-				   range(n, n + pages_per_cluster)))
+	def read_raw_clusters(self, n, count):
+		"""Read count consecutive clusters starting at n as stored.
 
-	def write_cluster(self, n, buf):
-		pages_per_cluster = self.pages_per_cluster
+		The clusters are read with a single read and returned
+		with the spare areas of their pages, if any, unchecked."""
+		
+		size = self.raw_page_size * self.pages_per_cluster
+		raw = self.storage.read(size * n, size * count)
+		if len(raw) != size * count:
+			raise corrupt, ("attempted to read past EOF"
+					" (cluster %05X)" % n, self.f)
+		return raw
+
+	def write_raw_clusters(self, n, raw):
+		"""Write clusters as stored, including any spare areas.
+
+		The data is written starting at cluster n with a single
+		write."""
+		
+		size = self.raw_page_size * self.pages_per_cluster
+		if len(raw) % size != 0:
+			raise error, ("internal error: write_raw_clusters:"
+				      " %d %% %d != 0" % (len(raw), size))
+		self.modified = True
+		self.storage.write(size * n, raw)
+
+	def make_raw_clusters(self, bufs):
+		"""Return the list of cluster buffers as stored in the image.
+
+		If the image has ECC, each page is followed by a spare area
+		holding its ECC codes."""
+		
 		cluster_size = self.cluster_size
-		if self.spare_size == 0:
-			self.f.seek(cluster_size * n)
+		for buf in bufs:
 			if len(buf) != cluster_size:
-				raise error, ("internal error: write_cluster:"
+				raise error, ("internal error: make_raw_clusters:"
 					      " %d != %d" % (len(buf),
 							     cluster_size))
-			return self.f.write(buf)
-		n *= pages_per_cluster
-		pgsize = self.page_size
-		for i in range(pages_per_cluster):
-			self.write_page(n + i, buf[i * pgsize
-						   : i * pgsize + pgsize])
+		if self.spare_size == 0:
+			return bytearray().join(bufs)
+		page_size = self.page_size
+		ecc_size = div_round_up(page_size, 128) * 3
+		pad = "\0" * (self.spare_size - ecc_size)
+		raw = []
+		for buf in bufs:
+			ecc = ecc_calculate_pages(buf, page_size)
+			for i in range(self.pages_per_cluster):
+				off = i * page_size
+				raw.append(buf[off : off + page_size])
+				raw.append(ecc[i * ecc_size
+					       : i * ecc_size + ecc_size])
+				raw.append(pad)
+		return bytearray().join(raw)
 
+	def read_cluster(self, n):
+		return self.read_clusters(n, 1)
 
-	def _add_fat_cluster_to_cache(self, n, fat, dirty):
-		old = self.fat_cache.add(n, [fat, dirty])
-		if old != None:
-			(n, [fat, dirty]) = old
-			if dirty:
-				self.write_cluster(n, pack_fat(fat))
+	def read_clusters(self, n, count):
+		"""Read count consecutive clusters starting at n.
+
+		The raw image is read with a single read, the pages
+		are then checked and corrected as read_page() does."""
+		
+		raw = self.read_raw_clusters(n, count)
+		if self.spare_size == 0:
+			return raw
+		page_size = self.page_size
+		raw_page_size = self.raw_page_size
+		n *= self.pages_per_cluster
+		pages = "".join([raw[off : off + page_size]
+				 for off in range(0, len(raw), raw_page_size)])
+		if self.ignore_ecc:
+			return pages
+		spares = "".join([raw[off + page_size : off + raw_page_size]
+				  for off in range(0, len(raw),
+						   raw_page_size)])
+		(status, pages, spares) = ecc_check_pages(pages, spares,
+							  page_size)
+		if ECC_CHECK_FAILED in status:
+			raise ecc_error, ("Unrecoverable ECC error (page %d)"
+					  % (n + status.index(ECC_CHECK_FAILED)))
+		return pages
+
+	def write_cluster(self, n, buf):
+		self.write_clusters(n, [buf])
+
+	def write_clusters(self, n, bufs):
+		"""Write a list of cluster buffers to consecutive clusters.
+
+		The clusters are written with a single write, along with
+		their spare areas if the image has ECC."""
+		
+		self.write_raw_clusters(n, self.make_raw_clusters(bufs))
+
+	def _write_cluster_runs(self, clusters):
+		"""Write a list of (cluster, buffer) pairs sorted by cluster.
+
+		Each run of consecutive clusters is written with one
+		write_clusters() call."""
+		
+		i = 0
+		while i < len(clusters):
+			n = clusters[i][0]
+			j = i + 1
+			while (j < len(clusters)
+			       and clusters[j][0] == n + (j - i)):
+				j += 1
+			self.write_clusters(n, [buf for (c, buf)
+						in clusters[i:j]])
+			self.write_calls_saved += j - i - 1
+			i = j
+
+	def _evict_buffer(self, n, buf, dirty):
+		if n in self._readahead_pending:
+			self._readahead_pending.remove(n)
+			self.readahead_waste += 1
+		if dirty:
+			self._write_buffer(n, buf)
+
+	def _pack_buffer(self, buf):
+		if isinstance(buf, array.array):
+			return pack_fat(buf)
+		return buf
+
+	def _write_buffer(self, n, buf):
+		self.write_cluster(n, self._pack_buffer(buf))
+
+	def flush_buffer_pool(self):
+		"""Write out all the dirty buffers in the buffer pool."""
+		
+		pool = self.buffer_pool
+		if pool == None:
+			return
+		dirty = pool.dirty_items()
+		self._write_cluster_runs([(n, self._pack_buffer(buf))
+					  for (n, buf) in dirty])
+		for (n, buf) in dirty:
+			pool.mark_clean(n)
 
 	def _read_fat_cluster(self, n):
-		v = self.fat_cache.get(n)
-		if v != None:
+		fat = self.buffer_pool.get(n)
+		if fat != None:
 			# print "@@@ fat hit", n
-			return v[0]
+			return fat
 		# print "@@@ fat miss", n
 		fat = unpack_fat(self.read_cluster(n))
-		self._add_fat_cluster_to_cache(n, fat, False)
+		self.buffer_pool.add(n, fat)
 		return fat
 
 	def _write_fat_cluster(self, n, fat):
-		self._add_fat_cluster_to_cache(n, fat, True)
+		self.buffer_pool.add(n, fat, True)
 
-	def flush_fat_cache(self):
-		if self.fat_cache == None:
-			return
-		for (n, v) in self.fat_cache.items():
-			[fat, dirty] = v
-			if dirty:
-				self.write_cluster(n, pack_fat(fat))
-				v[1] = False
+	def pin_allocatable_cluster(self, n):
+		"""Keep allocatable cluster n in the buffer pool."""
+		
+		pool = self.buffer_pool
+		if pool == None:
+			return False
+		return pool.pin(n + self.allocatable_cluster_offset)
 
-	def _add_alloc_cluster_to_cache(self, n, buf, dirty):
-		old = self.alloc_cluster_cache.add(n, [buf, dirty])
-		if old != None:
-			(n, [buf, dirty]) = old
-			if dirty:
-				n += self.allocatable_cluster_offset
-				self.write_cluster(n, buf)
+	def unpin_allocatable_cluster(self, n):
+		pool = self.buffer_pool
+		if pool != None:
+			pool.unpin(n + self.allocatable_cluster_offset)
 		
 	def read_allocatable_cluster(self, n):
-		a = self.alloc_cluster_cache.get(n)
-		if a != None:
+		n += self.allocatable_cluster_offset
+		buf = self.buffer_pool.get(n)
+		if buf != None:
 			# print "@@@ cache hit", n
-			return a[0]
+			if n in self._readahead_pending:
+				self._readahead_pending.remove(n)
+				self.readahead_hits += 1
+			return buf
 		# print "@@@ cache miss", n
-		buf = self.read_cluster(n + self.allocatable_cluster_offset)
-		self._add_alloc_cluster_to_cache(n, buf, False)
+		buf = bytearray(self.read_cluster(n))
+		self.buffer_pool.add(n, buf)
 		return buf
 		
+	def read_allocatable_clusters(self, n, count):
+		"""Read count consecutive allocatable clusters starting at n.
+
+		Clusters in the buffer pool are taken from there, runs of
+		the rest are read from the image with read_clusters().  The
+		clusters read aren't added to the pool."""
+		
+		n += self.allocatable_cluster_offset
+		pool = self.buffer_pool
+		cached = [pool.get(i) for i in range(n, n + count)]
+		pending = self._readahead_pending
+		if pending:
+			hits = pending.intersection(xrange(n, n + count))
+			pending.difference_update(hits)
+			self.readahead_hits += len(hits)
+		ret = []
+		i = 0
+		while i < count:
+			if cached[i] != None:
+				ret.append(str(cached[i]))
+				i += 1
+				continue
+			j = i + 1
+			while j < count and cached[j] == None:
+				j += 1
+			ret.append(self.read_clusters(n + i, j - i))
+			i = j
+		return "".join(ret)
+		
+	def read_allocatable_cluster_ahead(self, clusters):
+		"""Read allocatable cluster clusters[0] and prefetch the rest.
+
+		The clusters in the list that aren't already in the buffer
+		pool are read into it, with each run of physically adjacent
+		clusters read using a single read.  Prefetched clusters
+		that are later read count as readahead hits, those evicted
+		from the pool unused count as readahead waste."""
+
+		pool = self.buffer_pool
+		offset = self.allocatable_cluster_offset
+		cluster_size = self.cluster_size
+		pending = self._readahead_pending
+		i = 0
+		while i < len(clusters):
+			n = clusters[i] + offset
+			if n in pool:
+				i += 1
+				continue
+			j = i + 1
+			while (j < len(clusters)
+			       and clusters[j] + offset == n + (j - i)
+			       and clusters[j] + offset not in pool):
+				j += 1
+			s = self.read_clusters(n, j - i)
+			for k in range(i, j):
+				off = (k - i) * cluster_size
+				buf = bytearray(buffer(s, off, cluster_size))
+				pool.add(clusters[k] + offset, buf,
+					 prefetch = True)
+				if k != 0:
+					pending.add(clusters[k] + offset)
+			i = j
+		return self.read_allocatable_cluster(clusters[0])
+
 	def write_allocatable_cluster(self, n, buf):
-		self._add_alloc_cluster_to_cache(n, buf, True)
+		"""Write a cluster through the buffer pool.
 
-	def flush_alloc_cluster_cache(self):
-		if self.alloc_cluster_cache == None:
+		Returns the buffer the pool holds for the cluster."""
+		
+		n += self.allocatable_cluster_offset
+		if not isinstance(buf, bytearray):
+			buf = bytearray(buf)
+		self._readahead_pending.discard(n)
+		self.buffer_pool.add(n, buf, True)
+		return buf
+
+	def _load_fat_table(self):
+		"""Read the entire FAT into a single flat array.
+
+		Once loaded, lookup_fat() and set_fat() index the array
+		directly instead of going through the FAT cache.  Only the
+		FAT clusters that are modified get written back by flush()."""
+
+		self.flush_buffer_pool()
+		epc = self.entries_per_cluster
+		end = self.allocatable_cluster_end
+		fat_clusters = div_round_up(end, epc)
+		ifc_list = self.indirect_fat_cluster_list
+		table = array.array('I')
+		cluster_list = []
+		indirect_fat = None
+		for i in range(fat_clusters):
+			if i % epc == 0:
+				indirect_fat = unpack_fat(
+					self.read_cluster(ifc_list[i / epc]))
+			cluster = indirect_fat[i % epc]
+			table.extend(unpack_fat(self.read_cluster(cluster)))
+			cluster_list.append(cluster)
+
+		# entries past the end of the allocatable clusters are kept
+		# separately so they can be written back unchanged
+		self.fat_table_tail = table[end:]
+		del table[end:]
+		self.fat_table_clusters = cluster_list
+		self.fat_table_dirty = set()
+		self.fat_table = table
+		# the FAT clusters in the buffer pool are now out of date
+		self._unpin_fat_cluster()
+		for cluster in cluster_list:
+			self.buffer_pool.discard(cluster)
+
+	def flush_fat_table(self):
+		table = self.fat_table
+		if table == None:
 			return
-		for (n, a) in self.alloc_cluster_cache.items():
-			[buf, dirty] = a
-			if dirty:
-				n += self.allocatable_cluster_offset
-				self.write_cluster(n, buf)
-				a[1] = False
+		epc = self.entries_per_cluster
+		clusters = []
+		for i in self.fat_table_dirty:
+			fat = table[i * epc : i * epc + epc]
+			if len(fat) != epc:
+				fat.extend(self.fat_table_tail)
+			clusters.append((self.fat_table_clusters[i],
+					 pack_fat(fat)))
+		clusters.sort()
+		self._write_cluster_runs(clusters)
+		self.fat_table_dirty.clear()
+
+	def _build_free_map(self):
+		"""Build the map of free clusters and the free cluster count.
+
+		The map is a bytearray with an element for each allocatable
+		cluster set to 1 if the cluster is free.  It's kept up to
+		date by set_fat()."""
+
+		end = self.allocatable_cluster_end
+		if self.fat_table != None:
+			s = pack_fat(self.fat_table)
+		else:
+			s = "".join([pack_fat(self.read_fat_cluster(i)[0])
+				     for i in range(div_round_up(
+					     end, self.entries_per_cluster))])
+		free_map = bytearray(s[3::4].translate(_free_map_trans))
+		del free_map[end:]
+		self.free_map = free_map
+		self.free_clusters = free_map.count("\x01")
+		self.free_cursor = 0
+		self.alloc_rover = 0
+
+	def _update_free_map(self, n, value):
+		free_map = self.free_map
+		if free_map == None:
+			return
+		if value & PS2MC_FAT_ALLOCATED_BIT:
+			if free_map[n]:
+				free_map[n] = 0
+				self.free_clusters -= 1
+		elif not free_map[n]:
+			free_map[n] = 1
+			self.free_clusters += 1
+			if n < self.free_cursor:
+				self.free_cursor = n
 
 	def read_fat_cluster(self, n):
 		indirect_offset = n % self.entries_per_cluster
@@ -943,7 +2050,18 @@ class ps2mc(object):
 		indirect_cluster = self.indirect_fat_cluster_list[dbl_offset]
 		indirect_fat = self._read_fat_cluster(indirect_cluster)
 		cluster = indirect_fat[indirect_offset]
-		return (self._read_fat_cluster(cluster), cluster)
+		fat = self._read_fat_cluster(cluster)
+		if cluster != self._pinned_fat_cluster:
+			# keep the FAT cluster being walked in the pool
+			self._unpin_fat_cluster()
+			if self.buffer_pool.pin(cluster):
+				self._pinned_fat_cluster = cluster
+		return (fat, cluster)
+
+	def _unpin_fat_cluster(self):
+		if self._pinned_fat_cluster != None:
+			self.buffer_pool.unpin(self._pinned_fat_cluster)
+			self._pinned_fat_cluster = None
 					      
 	def read_fat(self, n):
 		if n < 0 or n >= self.allocatable_cluster_end:
@@ -956,48 +2074,150 @@ class ps2mc(object):
 		return (fat, offset, cluster)
 
 	def lookup_fat(self, n):
+		table = self.fat_table
+		if table != None:
+			try:
+				return table[n]
+			except IndexError:
+				raise io_error, (EIO,
+						 "FAT cluster index out of range"
+						 " (%d)" % n)
 		(fat, offset, cluster) = self.read_fat(n)
 		return fat[offset]
 
 	def set_fat(self, n, value):
-		(fat, offset, cluster) = self.read_fat(n)
-		fat[offset] = value
-		self._write_fat_cluster(cluster, fat)
+		table = self.fat_table
+		if table != None:
+			try:
+				table[n] = value
+			except IndexError:
+				raise io_error, (EIO,
+						 "FAT cluster index out of range"
+						 " (%d)" % n)
+			self.fat_table_dirty.add(n / self.entries_per_cluster)
+		else:
+			(fat, offset, cluster) = self.read_fat(n)
+			fat[offset] = value
+			self._write_fat_cluster(cluster, fat)
+		self._update_free_map(n, value)
 		
 	def allocate_cluster(self):
-		epc = self.entries_per_cluster
-		allocatable_cluster_limit = self.allocatable_cluster_limit
-		
-		end = div_round_up(allocatable_cluster_limit, epc)
-		remainder = allocatable_cluster_limit % epc
-			
-		while self.fat_cursor < end:
-			(fat, cluster) = self.read_fat_cluster(self.fat_cursor)
-			if (self.fat_cursor == end - 1
-			    and remainder != 0):
-				n = min(fat[:remainder])
-			else: 
-				n = min(fat)
-			if (n & PS2MC_FAT_ALLOCATED_BIT) == 0:
-				offset = fat.index(n)
-				fat[offset] = PS2MC_FAT_CHAIN_END
-				self._write_fat_cluster(cluster, fat)
-				ret = self.fat_cursor * epc + offset
-				# print "@@@ allocated", ret
-				return ret
-			self.fat_cursor += 1
-		return None
+		"""Allocate a free cluster.
+
+		Returns the number of the cluster allocated, or None if
+		there are no free clusters."""
+
+		limit = self.allocatable_cluster_limit
+		n = self.free_map.find("\x01", self.free_cursor, limit)
+		if n == -1:
+			self.free_cursor = limit
+			return None
+		self.set_fat(n, PS2MC_FAT_CHAIN_END)
+		self.free_cursor = n + 1
+		# print "@@@ allocated", n
+		return n
 	
+	def _find_free_extent(self, count, limit):
+		"""Find a run of count contiguous free clusters.
+
+		Returns the first cluster of the run or -1 if there's
+		no run long enough."""
+		
+		free_map = self.free_map
+		start = self.free_cursor
+		if self.alloc_policy == PS2MC_ALLOC_NEXT_FIT:
+			run = "\x01" * count
+			n = free_map.find(run, max(self.alloc_rover, start),
+					  limit)
+			if n == -1:
+				n = free_map.find(run, start, limit)
+			return n
+
+		# best-fit: look for the smallest run that's long enough
+		best = -1
+		best_len = None
+		i = free_map.find("\x01", start, limit)
+		while i != -1:
+			j = free_map.find("\x00", i, limit)
+			if j == -1:
+				j = limit
+			l = j - i
+			if l >= count and (best_len == None or l < best_len):
+				best = i
+				best_len = l
+				if l == count:
+					break
+			i = free_map.find("\x01", j, limit)
+		return best
+
+	def allocate_clusters(self, count):
+		"""Allocate a chain of count clusters.
+
+		The clusters are linked together in the FAT and a list of
+		them in chain order is returned.  They're allocated
+		contiguously if possible, using the placement policy given
+		by alloc_policy.  Otherwise the lowest numbered free
+		clusters are used.  Returns None without allocating
+		anything if there aren't enough free clusters."""
+		
+		if count < 1:
+			return []
+		if count > self.free_clusters:
+			return None
+		free_map = self.free_map
+		limit = self.allocatable_cluster_limit
+		n = self._find_free_extent(count, limit)
+		if n != -1:
+			chain = range(n, n + count)
+		else:
+			chain = []
+			i = free_map.find("\x01", self.free_cursor, limit)
+			while i != -1 and len(chain) < count:
+				j = free_map.find("\x00", i, limit)
+				if j == -1:
+					j = limit
+				chain += range(i, min(j, i + count - len(chain)))
+				i = free_map.find("\x01", j, limit)
+			if len(chain) < count:
+				return None
+
+		values = [cluster | PS2MC_FAT_ALLOCATED_BIT
+			  for cluster in chain[1:]]
+		values.append(PS2MC_FAT_CHAIN_END)
+		table = self.fat_table
+		first = chain[0]
+		if table != None and chain[-1] - first == count - 1:
+			# link a contiguous chain in one go
+			epc = self.entries_per_cluster
+			table[first : first + count] = array.array('I', values)
+			self.fat_table_dirty.update(
+				range(first / epc, (first + count - 1) / epc + 1))
+			free_map[first : first + count] = bytearray(count)
+			self.free_clusters -= count
+		else:
+			for (cluster, value) in zip(chain, values):
+				self.set_fat(cluster, value)
+		self.alloc_rover = chain[-1] + 1
+		return chain
+
 	def fat_chain(self, first_cluster):
 		return fat_chain(self.lookup_fat, first_cluster)
 
 	def file(self, dirloc, first_cluster, length, mode, name = None):
 		"""Create a new file-like object for a file."""
 		
-		f = ps2mc_file(self, dirloc, first_cluster, length, mode, name)
+		open_files = self.open_files
+		if dirloc in open_files:
+			# the directory entry may not be up to date if
+			# the file is already open in write-behind mode
+			for g in open_files[dirloc][1]:
+				first_cluster = g.first_cluster
+				length = g.length
+				break
+		f = ps2mc_file(self, dirloc, first_cluster, length, mode, name,
+			       self.write_behind)
 		if dirloc == None:
 			return
-		open_files = self.open_files
 		if dirloc not in open_files:
 			open_files[dirloc] = [None, set([f])]
 		else:
@@ -1028,22 +2248,37 @@ class ps2mc(object):
 		self.rootdir = dir
 		return dir
 
+	def update_dentry(self, dirloc, ent):
+		"""Tell the dentry cache the entry at dirloc was written."""
+		
+		cache = self.dentry_cache
+		if cache != None:
+			cache.update(dirloc, ent)
+
 	def _get_parent_dirloc(self, dirloc):
 		"""Get the dirloc of the parent directory of the
 		file or directory refered to by dirloc"""
 		
-		cluster = self.read_allocatable_cluster(dirloc[0])
-		ent = unpack_dirent(cluster[:PS2MC_DIRENT_LENGTH])
+		dotloc = (dirloc[0], 0)
+		ent = self.dentry_cache.get(dotloc)
+		if ent == None:
+			cluster = self.read_allocatable_cluster(dirloc[0])
+			ent = unpack_dirent(cluster[:PS2MC_DIRENT_LENGTH])
+			self.dentry_cache.add(dotloc, ent)
 		return (ent[4], ent[5])
 
 	def _dirloc_to_ent(self, dirloc):
 		"""Get the directory entry of the file or directory
 		refered to by dirloc"""
 		
+		ent = self.dentry_cache.get(dirloc)
+		if ent != None:
+			return ent
 		dir = self._directory(None, dirloc[0], dirloc[1] + 1,
 				      name = "_dirloc_to_ent temp")
 		ent = dir[dirloc[1]]
 		dir.close()
+		self.dentry_cache.add(dirloc, ent)
 		return ent
 
 	def _opendir_dirloc(self, dirloc, mode = "rb"):
@@ -1074,7 +2309,9 @@ class ps2mc(object):
 			if opened != None:
 				opened[0] = dir
 		
-		ent = dir[dirloc[1]]
+		ent = self.dentry_cache.get(dirloc)
+		if ent == None:
+			ent = dir[dirloc[1]]
 		# print "@@@ old_ent", ent
 		
 		is_dir = ent[0] & DF_DIR
@@ -1107,9 +2344,7 @@ class ps2mc(object):
 
 		
 		if notify:
-			for f in files:
-				if f != thisf:
-					f.update_notfiy(ent[4], ent[2])
+			self.notify_open_files(dirloc, thisf, ent[4], ent[2])
 		if opened == None:
 			dir.close()
 
@@ -1126,6 +2361,17 @@ class ps2mc(object):
 					first_cluster, None, modified, None,
 					None))
 			
+	def notify_open_files(self, dirloc, thisf, first_cluster, length):
+		"""Tell all the other open handles of a file that its first
+		cluster or length has changed."""
+		
+		opened = self.open_files.get(dirloc, None)
+		if opened == None:
+			return
+		for f in opened[1]:
+			if f != thisf:
+				f.update_notify(first_cluster, length)
+			
 	def notify_closed(self, dirloc, thisf):
 		if self.open_files == None or dirloc == None:
 			return
@@ -1141,22 +2387,31 @@ class ps2mc(object):
 				dir.close()
 			del self.open_files[dirloc]
 			
+	def _directory_index(self, dir):
+		"""Return the directory_index of an open directory.
+
+		The index is built the first time the directory is used
+		by reading all of its entries at once."""
+
+		dir_cluster = dir.f.first_cluster
+		index = self.dentry_cache.get_dir(dir_cluster)
+		if index != None and index.length == len(dir):
+			return index
+		ents = dir.read_all()
+		if len(ents) != len(dir):
+			raise corrupt("Corrupt directory", dir.f)
+		return self.dentry_cache.add_dir(dir_cluster, ents)
+
 	def search_directory(self, dir, name):
 		"""Search dir for name."""
 
-		# start the search where the last search ended.
-		start = dir.tell() - 1
-		if start == -1:
-			start = 0
-		for i in range(start, len(dir)) + range(0, start):
-			try:
-				ent = dir[i]
-			except IndexError:
-				raise corrupt("Corrupt directory", dir.f)
-				
-			if ent[8] == name and (ent[0] & DF_EXISTS):
-				return (i, ent)
-		return (None, None)
+		i = self._directory_index(dir).find(name)
+		if i == None:
+			return (None, None)
+		ent = self.dentry_cache.get((dir.f.first_cluster, i))
+		if ent == None:
+			ent = dir[i]
+		return (i, ent)
 
 	def create_dir_entry(self, parent_dirloc, name, mode):
 		"""Create a new directory entry in a directory."""
@@ -1171,12 +2426,8 @@ class ps2mc(object):
 		l = len(dir)
 		# print "@@@ len", l
 		assert l >= 2
-		for i in range(l):
-			ent = dir[i]
-			if (ent[0] & DF_EXISTS) == 0:
-				break
-		else:
-			i = l
+		i = self._directory_index(dir).first_free()
+		ent = [None] * 9
 			
 		dirloc = (dir_ent[4], i)
 		# print "@@@ dirloc", dirloc
@@ -1209,6 +2460,7 @@ class ps2mc(object):
 		dirent = pack_dirent((DF_RWX | DF_0400 | DF_DIR | DF_EXISTS,
 				      0, 0, now, dirloc[0], dirloc[1],
 				      now, 0, "."))
+		self.update_dentry((cluster, 0), unpack_dirent(dirent))
 		dirent += "\0" * (self.cluster_size - PS2MC_DIRENT_LENGTH)
 		self.write_allocatable_cluster(cluster, dirent)
 		dir = self._directory(dirloc, cluster, 1, "wb",
@@ -1238,8 +2490,6 @@ class ps2mc(object):
 			raise io_error, (EBUSY,
 					 "cannot remove open file", filename)
 
-		epc = self.entries_per_cluster
-
 		ent = self._dirloc_to_ent(dirloc)
 		cluster = ent[4]
 		if truncate:
@@ -1251,8 +2501,6 @@ class ps2mc(object):
 		self.update_dirent_all(dirloc, None, ent)
 		
 		while cluster != PS2MC_FAT_CHAIN_END:
-			if cluster / epc < self.fat_cursor:
-				self.fat_cursor = cluster / epc
 			next_cluster = self.lookup_fat(cluster)
 			if next_cluster & PS2MC_FAT_ALLOCATED_BIT == 0:
 				# corrupted
@@ -1262,6 +2510,29 @@ class ps2mc(object):
 			if next_cluster == PS2MC_FAT_CHAIN_END_UNALLOC:
 				break
 			cluster = next_cluster
+
+		if not truncate and (ent[0] & DF_DIR):
+			# the directory's clusters can now be reused
+			self.dentry_cache.clear()
+
+	def _search_dentry(self, dirloc, dirent, name):
+		"""Search the directory given by dirloc and dirent for name,
+		using the dentry cache if possible."""
+
+		dir_cluster = dirent[4]
+		(hit, i) = self.dentry_cache.find(dir_cluster, name)
+		if hit:
+			if i == None:
+				return (None, None)
+			return (i, self._dirloc_to_ent((dir_cluster, i)))
+		dir = self._directory(dirloc, dir_cluster, dirent[2],
+				      name = "<path_search temp>")
+		try:
+			(i, ent) = self.search_directory(dir, name)
+		finally:
+			dir.close()
+		self.dentry_cache.add_name(dir_cluster, name, i, ent)
+		return (i, ent)
 			
 	def path_search(self, pathname):
 		"""Parse and resolve a pathname.
@@ -1287,24 +2558,14 @@ class ps2mc(object):
 		if relative:
 			dirloc = self.curdir
 
-		tmpname = "<path_search temp>"
-		_directory = self._directory
-		
-		if dirloc == (0, 0):
-			rootent = self.read_allocatable_cluster(0)
-			ent = unpack_dirent(rootent[:PS2MC_DIRENT_LENGTH])
-			dir_cluster = 0
-			dir = _directory(dirloc, dir_cluster, ent[2],
-					      name = tmpname)
-		else:
-			ent = self._dirloc_to_ent(dirloc)
-			dir = _directory(dirloc, ent[4], ent[2],
-					 name = tmpname)
+		ent = self._dirloc_to_ent(dirloc)
+		# whether dirloc and ent refer to a directory
+		in_dir = True
 
 		for s in components:
-			# print "@@@", dirloc, repr(s), dir == None, ent
+			# print "@@@", dirloc, repr(s), in_dir, ent
 
-			if dir == None:
+			if not in_dir:
 				# tried to traverse a file or a
 				# non-existent directory
 				return (None, (0, 0, 0, 0, 0, 0, 0, 0, None),
@@ -1313,29 +2574,22 @@ class ps2mc(object):
 			if s == ".":
 				continue
 			if s == "..":
-				dotent = dir[0]
-				dir.close()
-				dirloc = (dotent[4], dotent[5])
+				dirloc = self._get_parent_dirloc((ent[4], 0))
 				ent = self._dirloc_to_ent(dirloc)
-				dir = _directory(dirloc, ent[4], ent[2],
-						 name = tmpname)
 				continue
 
 			dir_cluster = ent[4]
-			(i, ent) = self.search_directory(dir, s)
-			dir.close()
-			dir = None
+			(i, ent) = self._search_dentry(dirloc, ent, s)
+			in_dir = False
 
 			if ent == None:
 				continue
 			
 			dirloc = (dir_cluster, i)
 			if ent[0] & DF_DIR:
-				dir = _directory(dirloc, ent[4], ent[2],
-						 name = tmpname)
+				in_dir = True
 
-		if dir != None:
-			dir.close()
+		if in_dir:
 			is_dir = True
 		elif ent != None:
 			is_dir = False
@@ -1369,7 +2623,9 @@ class ps2mc(object):
 			ent[2] = 0
 		return self.file(dirloc, ent[4], ent[2], mode, filename)
 
-	def dir_open(self, filename, mode = "rb"):
+	def _dir_search(self, filename):
+		"""Return the dirloc and entry of the directory filename."""
+		
 		(dirloc, ent, is_dir) = self.path_search(filename)
 		if dirloc == None:
 			raise path_not_found, filename
@@ -1377,6 +2633,10 @@ class ps2mc(object):
 			raise dir_not_found, filename
 		if not is_dir:
 			raise io_error, (ENOTDIR, "not a directory", filename)
+		return (dirloc, ent)
+
+	def dir_open(self, filename, mode = "rb"):
+		(dirloc, ent) = self._dir_search(filename)
 		return self.directory(dirloc, ent[4], ent[2], mode, filename)
 
 	def mkdir(self, filename):
@@ -1395,12 +2655,9 @@ class ps2mc(object):
 		dir = self._directory(dirloc, ent[4], ent[2], "rb",
 				      filename)
 		try:
-			for i in range(2, len(dir)):
-				if dir[i][0] & DF_EXISTS:
-					return False
+			return self._directory_index(dir).is_empty()
 		finally:
 			dir.close()
-		return True
 		
 	def remove(self, filename):
 		"""Remove a file or empty directory."""
@@ -1555,6 +2812,9 @@ class ps2mc(object):
 			newdir.write_raw_ent(0, dotent, False)
 		finally:
 			newdir.close()
+			# anything cached under the old location of
+			# the directory tree is no longer reachable
+			self.dentry_cache.clear()
 			
 			
 	def import_save_file(self, sf, ignore_existing, dirname = None):
@@ -1596,7 +2856,7 @@ class ps2mc(object):
 				f = self.file(dirloc, ent[4], ent[2], "wb",
 					      dirname + ent[8])
 				try:
-					f.write(data)
+					f.write_all(data)
 				finally:
 					f.close()
 		except EnvironmentError:
@@ -1690,7 +2950,7 @@ class ps2mc(object):
 		dir = self._directory(dirloc, first_cluster, length,
 				      "rb", dirname)
 		try:
-			ents = list(enumerate(dir))
+			ents = list(enumerate(dir.read_all()))
 		finally:
 			dir.close()
 		for (i, ent) in ents[2:]:
@@ -1727,11 +2987,7 @@ class ps2mc(object):
 	def get_free_space(self):
 		"""Returns the amount of free space in bytes."""
 		
-		free = 0
-		for i in xrange(self.allocatable_cluster_end):
-			if (self.lookup_fat(i) & PS2MC_FAT_ALLOCATED_BIT) == 0:
-				free += 1
-		return free * self.cluster_size
+		return self.free_clusters * self.cluster_size
 
 	def get_allocatable_space(self):
 		"""Returns the total amount of allocatable space in bytes."""
@@ -1772,19 +3028,23 @@ class ps2mc(object):
 		length = ent[2]
 		dir = self._directory(dirloc, first_cluster, length,
 				      "rb", dirname)
-		dot_ent = dir[0]
+		ents = dir.read_all()
+		dir.close()
+		if len(ents) < max(length, 2):
+			raise dir_index_not_found(dirname, len(ents))
+		dot_ent = ents[0]
 		if dot_ent[8] != ".":
 			print "bad directory:", dirname + ': missing "." entry'
 			ret = False
 		if (dot_ent[4], dot_ent[5]) != dirloc:
 			print "bad directory:", dirname + ': bad "." entry'
 			ret = False
-		if dir[1][8] != "..":
+		if ents[1][8] != "..":
 			print "bad directory:", (dirname
 						 + ': missing ".." entry')
 			ret = False
 		for i in xrange(2, length):
-			ent = dir[i]
+			ent = ents[i]
 			mode = ent[0]
 			if not (mode & DF_EXISTS):
 				continue
@@ -1799,10 +3059,172 @@ class ps2mc(object):
 					print "bad file:", (dirname + ent[8]
 							    + ":"), why
 					ret = False
-				
-		dir.close()
 		return ret
 		
+	def scan(self, jobs = 1):
+		"""Check the ECC codes of every page in the image.
+
+		The image is checked in ranges of erase blocks, spread
+		over a pool of jobs processes if jobs is greater than one.
+		Returns a dictionary with the number of "pages" checked, the
+		number of "clean" pages, the number of "erased" pages, lists
+		of the "corrected" and "failed" (uncorrectable) pages, the
+		number of "bytes" read, the "seconds" taken and the
+		resulting "throughput" in bytes per second.  Erased pages,
+		like those of the reserved good block that
+		write_superblock() fills with ones, have no valid ECC codes
+		and are only counted.  Pages missing from a truncated image
+		count as failed."""
+		
+		if self.spare_size == 0:
+			raise error, "image has no ECC codes to check"
+		self.flush()
+		page_size = self.page_size
+		raw_page_size = self.raw_page_size
+		total = self.clusters_per_card * self.pages_per_cluster
+		step = self.pages_per_erase_block * PS2MC_SCAN_BLOCKS
+		ranges = [(i, min(step, total - i))
+			  for i in range(0, total, step)]
+		filename = getattr(self.f, "name", None)
+		if not isinstance(filename, str):
+			jobs = 1
+
+		start = time.time()
+		if jobs > 1:
+			import multiprocessing
+			pool = multiprocessing.Pool(jobs)
+			try:
+				results = pool.map(_scan_file_range,
+						   [(filename, first, count,
+						     page_size, raw_page_size)
+						    for (first, count)
+						    in ranges])
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			results = []
+			for (first, count) in ranges:
+				raw = self.storage.read(first * raw_page_size,
+							count * raw_page_size)
+				results.append((len(raw),
+						_scan_raw_pages(raw, page_size,
+								raw_page_size,
+								first)))
+		seconds = time.time() - start
+
+		length = 0
+		clean = 0
+		erased = 0
+		corrected = []
+		failed = []
+		for ((first, count), (l, r)) in zip(ranges, results):
+			length += l
+			clean += r[0]
+			erased += r[1]
+			corrected += r[2]
+			failed += r[3]
+			failed += range(first + l / raw_page_size,
+					first + count)
+		return {"pages": total,
+			"clean": clean,
+			"erased": erased,
+			"corrected": corrected,
+			"failed": failed,
+			"bytes": length,
+			"seconds": seconds,
+			"throughput": length / max(seconds, 1e-6)}
+
+	def scrub(self):
+		"""Correct the ECC errors in the image in place.
+
+		Every page is checked and the corrected data and spare
+		areas of pages with single bit errors are written back,
+		a run of consecutive pages at a time, so later reads
+		don't need to correct them again.  Erased pages are left
+		alone.  The reserved good blocks aren't checked, counted
+		or written at all.  Returns a dictionary like scan()
+		does, with an additional entry "blocks" that maps the
+		number of each erase block with corrected pages to the
+		number of pages corrected in it."""
+		
+		if self.spare_size == 0:
+			raise error, "image has no ECC codes to check"
+		self.flush()
+		page_size = self.page_size
+		spare_size = self.spare_size
+		raw_page_size = self.raw_page_size
+		ppeb = self.pages_per_erase_block
+		total = self.clusters_per_card * self.pages_per_cluster
+		step = ppeb * PS2MC_SCAN_BLOCKS
+		storage = self.storage
+		reserved = [self.good_block1, self.good_block2]
+
+		start = time.time()
+		length = 0
+		clean = 0
+		erased = 0
+		corrected = []
+		failed = []
+		blocks = {}
+		for first in range(0, total, step):
+			count = min(step, total - first)
+			raw = storage.read(first * raw_page_size,
+					   count * raw_page_size)
+			length += len(raw)
+			n = len(raw) / raw_page_size
+			failed += [page
+				   for page in range(first + n, first + count)
+				   if page / ppeb not in reserved]
+			(pages, spares) = _split_raw_pages(raw, page_size,
+							   raw_page_size)
+			(status, pages, spares) = ecc_check_pages(pages, spares,
+								  page_size)
+			# pages to leave alone get a status of None
+			status = list(status)
+			erased_pages = _erased_raw_pages(raw, raw_page_size)
+			for i in range(n):
+				if (first + i) / ppeb in reserved:
+					status[i] = None
+				elif i in erased_pages:
+					status[i] = None
+					erased += 1
+			i = 0
+			while i < n:
+				if status[i] != ECC_CHECK_CORRECTED:
+					if status[i] == ECC_CHECK_OK:
+						clean += 1
+					elif status[i] == ECC_CHECK_FAILED:
+						failed.append(first + i)
+					i += 1
+					continue
+				j = i
+				while (j < n
+				       and status[j] == ECC_CHECK_CORRECTED):
+					page = first + j
+					corrected.append(page)
+					blocks[page / ppeb] = (
+						blocks.get(page / ppeb, 0) + 1)
+					j += 1
+				run = "".join([pages[k * page_size
+						     : (k + 1) * page_size]
+					       + spares[k * spare_size
+							: (k + 1) * spare_size]
+					       for k in range(i, j)])
+				storage.write((first + i) * raw_page_size, run)
+				i = j
+		storage.flush()
+		seconds = time.time() - start
+		return {"pages": total - len(reserved) * ppeb,
+			"clean": clean,
+			"erased": erased,
+			"corrected": corrected,
+			"failed": failed,
+			"blocks": blocks,
+			"bytes": length,
+			"seconds": seconds,
+			"throughput": length / max(seconds, 1e-6)}
+
 	def check(self):
 		"""Run a simple file system check.
 
@@ -1816,16 +3238,21 @@ class ps2mc(object):
 
 		fat = array.array('B', [0]) * fat_len
 
-		cluster = self.read_allocatable_cluster(0)
-		ent = unpack_dirent(cluster[:PS2MC_DIRENT_LENGTH])
-		ret = self._check_dir(fat, (0, 0), "/", ent)
-
-		lost_clusters = 0
-		for i in xrange(self.allocatable_cluster_end):
-			a = self.lookup_fat(i)
-			if (a & PS2MC_FAT_ALLOCATED_BIT) and not fat[i]:
-				print i,
-				lost_clusters += 1
+		self.buffer_pool.begin_scan()
+		try:
+			cluster = self.read_allocatable_cluster(0)
+			ent = unpack_dirent(cluster[:PS2MC_DIRENT_LENGTH])
+			ret = self._check_dir(fat, (0, 0), "/", ent)
+
+			lost_clusters = 0
+			for i in xrange(self.allocatable_cluster_end):
+				a = self.lookup_fat(i)
+				if ((a & PS2MC_FAT_ALLOCATED_BIT)
+				    and not fat[i]):
+					print i,
+					lost_clusters += 1
+		finally:
+			self.buffer_pool.end_scan()
 		if lost_clusters > 0:
 			print
 			print "found", lost_clusters, "lost clusters"
@@ -1840,10 +3267,16 @@ class ps2mc(object):
 		else:
 			dir = self.dir_open(dirname)
 		try:
+			if _glob_is_literal(pattern):
+				(i, ent) = self.search_directory(dir, pattern)
+				if ent == None or (is_dir
+						   and not (ent[0] & DF_DIR)):
+					return []
+				return [dirname + ent[8]]
 			return [dirname + ent[8]
-				for ent in dir
+				for ent in dir.read_all()
 				if ((ent[0] & DF_EXISTS)
-				    and (not is_dir or (ent[8] & DF_DIR))
+				    and (not is_dir or (ent[0] & DF_DIR))
 				    and (ent[8] not in [".", ".."]
 					 or ent[8] == pattern)
 				    and fnmatch.fnmatchcase(ent[8],
@@ -1866,7 +3299,13 @@ class ps2mc(object):
 			dir = self.dir_open(dirname)
 		try:
 			ret = []
-			for ent in dir:
+			if _glob_is_literal(pattern):
+				(i, ent) = self.search_directory(dir, pattern)
+				if ent != None and (ent[0] & DF_DIR):
+					ret = _glob(dirname + ent[8] + "/",
+						    components, is_dir)
+				return ret
+			for ent in dir.read_all():
 				name = ent[8]
 				if ((ent[0] & DF_EXISTS) == 0
 				    or (ent[0] & DF_DIR) == 0):
@@ -1913,6 +3352,193 @@ class ps2mc(object):
 			return s;
 		return None
 
+	def _snapshot_chain(self, first_cluster, count):
+		chain = self.fat_chain(first_cluster)
+		clusters = []
+		for i in range(count):
+			cluster = chain[i]
+			if cluster == PS2MC_FAT_CHAIN_END:
+				break
+			clusters.append(cluster)
+		return tuple(clusters)
+
+	def _snapshot_entry(self, dirs, dirloc, ent, name, parents):
+		cluster_size = self.cluster_size
+		mode = ent[0]
+		is_dir = mode_is_dir(mode) and name not in [".", ".."]
+		if is_dir:
+			size = div_round_up(ent[2] * PS2MC_DIRENT_LENGTH,
+					    cluster_size)
+		elif mode_is_file(mode):
+			size = div_round_up(ent[2], cluster_size)
+		else:
+			size = 0
+		chain = self._snapshot_chain(ent[4], size)
+		if not is_dir:
+			return snapshot_entry(name, tuple(ent), dirloc, size,
+					      chain, None)
+
+		entries = []
+		first_cluster = ent[4]
+		# guard against directories that contain themselves
+		if first_cluster not in parents:
+			parents.add(first_cluster)
+			ents = dirs.get(first_cluster, [])
+			for i in range(len(ents)):
+				sub = ents[i]
+				if (sub[0] & DF_EXISTS) == 0:
+					continue
+				entry = self._snapshot_entry(dirs,
+							     (first_cluster, i),
+							     sub, sub[8],
+							     parents)
+				size += entry.size
+				entries.append(entry)
+			parents.remove(first_cluster)
+		return snapshot_entry(name, tuple(ent), dirloc, size, chain,
+				      tuple(entries))
+
+	def _snapshot_file(self, entry, name, length):
+		"""Find the file called name in a snapshot_entry.
+
+		Returns the tuple (clusters, length) giving the clusters
+		that hold the first length bytes of the file, or None if
+		there's no such file."""
+
+		for sub in entry.entries:
+			if sub.name == name:
+				break
+		else:
+			return None
+		if not mode_is_file(sub.dirent[0]):
+			return None
+		length = min(length, sub.dirent[2])
+		count = div_round_up(length, self.cluster_size)
+		return (sub.chain[:count], length)
+
+	def _snapshot_dirs(self, first_cluster, length):
+		"""Read a directory and all the directories below it.
+
+		The directories are read in the order of their first
+		clusters.  Returns a dictionary mapping the first cluster
+		of each directory to the list of its entries."""
+		
+		dirs = {}
+		pending = [(first_cluster, length)]
+		while len(pending) > 0:
+			(cluster, length) = heapq.heappop(pending)
+			if cluster in dirs:
+				continue
+			dirloc = None
+			if cluster == 0:
+				dirloc = (0, 0)
+			dir = self._directory(dirloc, cluster, length, "rb",
+					      "<snapshot temp>")
+			try:
+				ents = dir.read_all()
+			finally:
+				dir.close()
+			dirs[cluster] = ents
+			for ent in ents:
+				if (mode_is_dir(ent[0])
+				    and ent[8] not in [".", ".."]):
+					heapq.heappush(pending, (ent[4], ent[2]))
+		return dirs
+
+	def snapshot(self):
+		"""Return a card_snapshot with the metadata of the whole card.
+
+		Every directory is read once, in the order of their first
+		clusters, and then the icon.sys files and PSX save headers
+		are read in the order of their clusters as well.  The
+		snapshot is built from tuples, so it won't change when the
+		card does."""
+
+		self.flush()
+		root_ent = self._dirloc_to_ent((0, 0))
+		dirs = self._snapshot_dirs(0, root_ent[2])
+		root = self._snapshot_entry(dirs, (0, 0), root_ent, "/", set())
+
+		# find the files in each save that need to be read
+		reads = []
+		for entry in root.entries:
+			if entry.entries == None:
+				continue
+			reads.append(self._snapshot_file(entry, "icon.sys",
+							 964))
+			reads.append(self._snapshot_file(entry, entry.name,
+							 128))
+		clusters = set()
+		for r in reads:
+			if r != None:
+				clusters.update(r[0])
+		data = {}
+		for cluster in sorted(clusters):
+			data[cluster] = str(self.read_allocatable_cluster(cluster))
+
+		saves = []
+		i = 0
+		for entry in root.entries:
+			if entry.entries == None:
+				continue
+			contents = []
+			for r in reads[i : i + 2]:
+				if r != None:
+					(chain, length) = r
+					r = "".join([data[cluster]
+						     for cluster in chain])
+					r = r[:length]
+				contents.append(r)
+			(icon_sys, psx_header) = contents
+			if icon_sys != None and (len(icon_sys) != 964
+						 or icon_sys[:4] != "PS2D"):
+				icon_sys = None
+			if psx_header != None and len(psx_header) != 128:
+				psx_header = None
+			saves.append(snapshot_save(entry, icon_sys, psx_header))
+			i += 2
+
+		return card_snapshot(root, tuple(saves), self.cluster_size,
+				     self.free_clusters,
+				     self.allocatable_cluster_limit)
+
+	def dir_snapshot(self, dirname, snapshot = None):
+		"""Return the snapshot_entry of a directory.
+
+		The entry is taken from snapshot if given.  Otherwise only
+		the directory itself is read, and the size and chain of it
+		and its entries are None, as are the entries of any
+		subdirectories."""
+		
+		(dirloc, ent) = self._dir_search(dirname)
+		if snapshot != None:
+			entry = snapshot.find(dirloc)
+			if entry == None or entry.entries == None:
+				raise dir_not_found, dirname
+			return entry
+		if not mode_is_dir(ent[0]):
+			raise dir_not_found, dirname
+		self.flush()
+		name = ent[8]
+		if dirloc == (0, 0):
+			name = "/"
+		dir = self._directory(dirloc, ent[4], ent[2], "rb", dirname)
+		try:
+			ents = dir.read_all()
+		finally:
+			dir.close()
+		first_cluster = ent[4]
+		entries = []
+		for i in range(len(ents)):
+			sub = ents[i]
+			if (sub[0] & DF_EXISTS) == 0:
+				continue
+			entries.append(snapshot_entry(sub[8], tuple(sub),
+						      (first_cluster, i),
+						      None, None, None))
+		return snapshot_entry(name, tuple(ent), dirloc, None, None,
+				      tuple(entries))
+
 	def dir_size(self, dirname):
 		"""Calculate the total size of the contents of a directory."""
 
@@ -1920,7 +3546,7 @@ class ps2mc(object):
 		try:
 			length = round_up(len(dir) * PS2MC_DIRENT_LENGTH,
 					  self.cluster_size)
-			for ent in dir:
+			for ent in dir.read_all():
 				if mode_is_file(ent[0]):
 					length += round_up(ent[2],
 							   self.cluster_size)
@@ -1933,11 +3559,23 @@ class ps2mc(object):
 		return length
 			
 	def flush(self):
-		self.flush_alloc_cluster_cache()
-		self.flush_fat_cache()
+		if self.open_files != None:
+			for (dir, files) in self.open_files.values():
+				for f in list(files):
+					f.flush_pending()
+		self.flush_buffer_pool()
+		self.flush_fat_table()
 		if self.modified:
 			self.write_superblock()
-		self.f.flush()
+		self.storage.flush()
+		
+	def to_bytes(self):
+		"""Flush any changes and return the whole image as a string."""
+		
+		self.flush()
+		return self.storage.read(0, self.clusters_per_card
+					 * self.pages_per_cluster
+					 * self.raw_page_size)
 		
 	def close(self):
 		"""Close all open files.
@@ -1968,11 +3606,17 @@ class ps2mc(object):
 						dir.close()
 			if self.rootdir != None:
 				self.rootdir.close()
-			if self.fat_cache != None:
+			if self.buffer_pool != None:
 				self.flush()
 		finally:
+			if self.storage != None:
+				self.storage.close()
+			self.storage = None
 			self.open_files = None
-			self.fat_cache = None
+			self.buffer_pool = None
+			self.dentry_cache = None
+			self.fat_table = None
+			self.free_map = None
 			self.f = None
 			self.rootdir = None
 
@@ -1983,3 +3627,12 @@ class ps2mc(object):
 		except:
 			sys.stderr.write("ps2mc.__del__: \n")
 			traceback.print_exc()
+
+def from_bytes(image, ignore_ecc = False, **kwargs):
+	"""Open a memory card image held in a string.
+
+	The image is kept in memory, use the to_bytes() method of the
+	returned object to get the modified image."""
+
+	return ps2mc(StringIO.StringIO(image), ignore_ecc,
+		     storage = PS2MC_STORAGE_MEMORY, **kwargs)
@@ -46,6 +46,12 @@ def zero_terminate(s):
 # name
 _dirent_fmt = "<HHL8sLL8sL28x448s"
 
+# the fields before the name
+_dirent_head_fmt = "<HHL8sLL8sL"
+
+# offset of the name field
+_DIRENT_NAME_OFFSET = 64
+
 # secs, mins, hours, mday, month, year
 _tod_fmt = "<xBBBBBH"
 
@@ -54,6 +60,7 @@ _tod_fmt = "<xBBBBBH"
 # 
 if hasattr(struct, "Struct"):
 	_dirent_struct = struct.Struct(_dirent_fmt)
+	_dirent_head_struct = struct.Struct(_dirent_head_fmt)
 	_tod_struct = struct.Struct(_tod_fmt)
 
 	def unpack_tod(s):
@@ -61,16 +68,16 @@ if hasattr(struct, "Struct"):
 	
 	def pack_tod(tod):
 		return _tod_struct.pack(tod)
-	
-	def unpack_dirent(s):
-		ent = _dirent_struct.unpack(s)
-		ent = list(ent)
-		ent[3] = _tod_struct.unpack(ent[3])
-		ent[6] = _tod_struct.unpack(ent[6])
-		ent[8] = zero_terminate(ent[8])
-		return ent
 
-	def pack_dirent(ent):
+	def _unpack_dirent_head(s):
+		return _dirent_head_struct.unpack_from(s)
+
+	_dirent_mode_struct = struct.Struct("<H")
+
+	def _unpack_dirent_mode(s):
+		return _dirent_mode_struct.unpack_from(s)[0]
+	
+	def _pack_dirent_fields(ent):
 		ent = list(ent)
 		ent[3] = _tod_struct.pack(*ent[3])
 		ent[6] = _tod_struct.pack(*ent[6])
@@ -81,24 +88,157 @@ else:
 
 	def pack_tod(tod):
 		return struct.pack(_tod_fmt, tod)
-	
-	def unpack_dirent(s):
-		# mode, ???, length, created,
-		# fat_cluster, parent_entry, modified, attr,
-		# name
-		ent = struct.unpack(_dirent_fmt, s)
-		ent = list(ent)
-		ent[3] = struct.unpack(_tod_fmt, ent[3])
-		ent[6] = struct.unpack(_tod_fmt, ent[6])
-		ent[8] = zero_terminate(ent[8])
-		return ent
 
-	def pack_dirent(ent):
+	def _unpack_dirent_head(s):
+		return struct.unpack(_dirent_head_fmt,
+				     s[:_DIRENT_NAME_OFFSET - 28])
+
+	def _unpack_dirent_mode(s):
+		return struct.unpack("<H", s[:2])[0]
+	
+	def _pack_dirent_fields(ent):
 		ent = list(ent)
 		ent[3] = struct.pack(_tod_fmt, *ent[3])
 		ent[6] = struct.pack(_tod_fmt, *ent[6])
 		return struct.pack(_dirent_fmt, *ent)
 
+class dirent(object):
+	"""A directory entry, decoded from its packed form on demand.
+
+	Behaves like a list of the nine fields of the entry: mode, ???,
+	length, created, fat_cluster, parent_entry, modified, attr and
+	name.  The two times and the name are only decoded when they're
+	accessed.  Until a field is changed the packed form is kept, so
+	pack_dirent() can return it as is."""
+
+	__slots__ = ("_raw", "_fields", "_name")
+
+	def __init__(self, raw):
+		if len(raw) != PS2MC_DIRENT_LENGTH:
+			raise struct.error, ("unpack requires a string"
+					     " argument of length %d"
+					     % PS2MC_DIRENT_LENGTH)
+		if not isinstance(raw, str):
+			raw = str(raw)
+		self._raw = raw
+		self._fields = None
+		self._name = None
+
+	def _get_name(self):
+		name = self._name
+		if name == None:
+			raw = self._raw
+			end = raw.find("\0", _DIRENT_NAME_OFFSET)
+			if end == -1:
+				end = PS2MC_DIRENT_LENGTH
+			name = self._name = raw[_DIRENT_NAME_OFFSET : end]
+		return name
+
+	def _get_fields(self):
+		"""Return the list of fields other than the name.  The
+		times are left packed until they're needed."""
+		
+		fields = self._fields
+		if fields == None:
+			fields = self._fields = list(_unpack_dirent_head(
+				self._raw))
+		return fields
+
+	def _all(self):
+		fields = self._get_fields()
+		for i in [3, 6]:
+			if isinstance(fields[i], str):
+				fields[i] = unpack_tod(fields[i])
+		return fields + [self._get_name()]
+
+	def __getitem__(self, i):
+		if i == 0 and self._fields == None:
+			# checking the mode is by far the most common case
+			return _unpack_dirent_mode(self._raw)
+		if isinstance(i, slice):
+			return self._all()[i]
+		if i < 0:
+			i += 9
+		if i == 8:
+			return self._get_name()
+		fields = self._get_fields()
+		value = fields[i]
+		if (i == 3 or i == 6) and isinstance(value, str):
+			value = fields[i] = unpack_tod(value)
+		return value
+
+	def __setitem__(self, i, value):
+		fields = self._all()
+		fields[i] = value
+		if len(fields) != 9:
+			raise ValueError, "directory entries have nine fields"
+		self._fields = fields[:8]
+		self._name = fields[8]
+		self._raw = None
+
+	def __len__(self):
+		return 9
+
+	def __iter__(self):
+		return iter(self._all())
+
+	def __eq__(self, other):
+		if isinstance(other, dirent):
+			other = other[:]
+		elif not isinstance(other, list):
+			# avoid decoding the entry to compare it with None
+			return False
+		return self[:] == other
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __repr__(self):
+		return repr(self[:])
+
+	def copy(self):
+		"""Return a copy of the entry that can be modified separately."""
+		
+		ent = dirent.__new__(dirent)
+		ent._raw = self._raw
+		ent._name = self._name
+		if self._fields == None:
+			ent._fields = None
+		else:
+			ent._fields = list(self._fields)
+		return ent
+
+def copy_dirent(ent):
+	"""Return a modifiable copy of a directory entry."""
+	
+	if isinstance(ent, dirent):
+		return ent.copy()
+	return list(ent)
+
+def unpack_dirent(s):
+	return dirent(s)
+
+def unpack_dirents(s):
+	"""Unpack all the directory entries in s."""
+
+	s = str(s)
+	new = dirent.__new__
+	ents = []
+	for off in xrange(0, len(s) - PS2MC_DIRENT_LENGTH + 1,
+			  PS2MC_DIRENT_LENGTH):
+		# skip the checks done by dirent.__init__()
+		ent = new(dirent)
+		ent._raw = s[off : off + PS2MC_DIRENT_LENGTH]
+		ent._fields = None
+		ent._name = None
+		ents.append(ent)
+	return ents
+
+def pack_dirent(ent):
+	if isinstance(ent, dirent) and ent._raw != None:
+		return ent._raw
+	return _pack_dirent_fields(ent)
+
 def time_to_tod(when):
 	"""Convert a Python time value to a ToD tuple"""
 	
@@ -22,14 +22,25 @@ try:
 except ImportError:
 	mymcsup = None
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 __ALL__ = ["ECC_CHECK_OK", "ECC_CHECK_CORRECTED", "ECC_CHECK_FAILED",
 	   "ecc_calculate", "ecc_check",
-	   "ecc_calculate_page", "ecc_check_page"]
+	   "ecc_calculate_page", "ecc_check_page",
+	   "ecc_calculate_pages", "ecc_check_pages",
+	   "ecc_backends", "ecc_get_backend", "ecc_set_backend"]
 
 ECC_CHECK_OK = 0
 ECC_CHECK_CORRECTED = 1
 ECC_CHECK_FAILED = 2
 
+ECC_BACKEND_PYTHON = "python"
+ECC_BACKEND_NUMPY = "numpy"
+ECC_BACKEND_MYMCSUP = "mymcsup"
+
 def _popcount(a):
 	count = 0
 	while a != 0:
@@ -62,7 +73,7 @@ _parity_table, _column_parity_masks = _make_ecc_tables()
 def _ecc_calculate(s):
 	"Calculate the Hamming code for a 128 byte long string or byte array."
 	
-	if not isinstance(s, array.array):
+	if not isinstance(s, (array.array, bytearray)):
 		a = array.array('B')
 		a.fromstring(s)
 		s = a
@@ -77,6 +88,93 @@ def _ecc_calculate(s):
 			line_parity_1 ^= i
 	return [column_parity, line_parity_0 & 0x7F, line_parity_1]
 
+def _ecc_string(buf):
+	"""Return buf, a string, bytearray or array of bytes, as a string."""
+	
+	if isinstance(buf, array.array):
+		return buf.tostring()
+	return str(buf)
+
+def _ecc_calculate_chunks_python(buf):
+	a = array.array('B')
+	for off in range(0, len(buf), 128):
+		a.fromlist(_ecc_calculate(buf[off : off + 128]))
+	return a.tostring()
+
+if numpy != None:
+	_np_parity_table = numpy.array(_parity_table, numpy.uint8)
+	_np_column_parity_masks = numpy.array(_column_parity_masks,
+					      numpy.uint8)
+	_np_index = numpy.arange(128, dtype = numpy.uint8)
+
+	def _ecc_calculate_chunks_numpy(buf):
+		"""Calculate the Hamming codes of all the 128 byte chunks
+		in buf at once."""
+		
+		if len(buf) % 128 != 0:
+			# zero bytes don't change the code
+			buf = (_ecc_string(buf)
+			       + "\0" * (128 - len(buf) % 128))
+		data = numpy.frombuffer(buf, numpy.uint8).reshape(-1, 128)
+		column_parity = numpy.bitwise_xor.reduce(
+			_np_column_parity_masks[data], axis = 1)
+		parity = _np_parity_table[data]
+		# the xor of the offsets of the bytes with odd parity
+		lines = numpy.bitwise_xor.reduce(parity * _np_index,
+						 axis = 1)
+		odd = (parity.sum(axis = 1) & 1).astype(numpy.uint8)
+		codes = numpy.empty((len(data), 3), numpy.uint8)
+		codes[:, 0] = column_parity ^ 0x77
+		codes[:, 1] = lines ^ (odd * 0x7F) ^ 0x7F
+		codes[:, 2] = lines ^ 0x7F
+		return codes.tobytes()
+
+if mymcsup != None:
+	def _ecc_calculate_chunks_mymcsup(buf):
+		buf = _ecc_string(buf)
+		aecc = array.array('B', "\0\0\0")
+		cecc = ctypes.c_ubyte.from_address(aecc.buffer_info()[0])
+		ret = array.array('B')
+		for off in range(0, len(buf), 128):
+			s = buf[off : off + 128]
+			mymcsup.ecc_calculate(s, len(s), cecc)
+			ret.extend(aecc)
+		return ret.tostring()
+
+_ecc_backends = {ECC_BACKEND_PYTHON: _ecc_calculate_chunks_python}
+if numpy != None:
+	_ecc_backends[ECC_BACKEND_NUMPY] = _ecc_calculate_chunks_numpy
+if mymcsup != None:
+	_ecc_backends[ECC_BACKEND_MYMCSUP] = _ecc_calculate_chunks_mymcsup
+
+def ecc_backends():
+	"""Return the names of the available backends, fastest first."""
+	
+	return [name for name in [ECC_BACKEND_MYMCSUP, ECC_BACKEND_NUMPY,
+				  ECC_BACKEND_PYTHON]
+		if name in _ecc_backends]
+
+def ecc_get_backend():
+	return _ecc_backend
+
+def ecc_set_backend(name = None):
+	"""Select the backend used to calculate ECC codes.
+
+	With no name the fastest available backend is used."""
+	
+	global _ecc_backend, _ecc_calculate_chunks
+	if name == None:
+		name = ecc_backends()[0]
+	if name not in _ecc_backends:
+		raise ValueError, "ECC backend %s not available" % repr(name)
+	_ecc_backend = name
+	_ecc_calculate_chunks = _ecc_backends[name]
+
+def ecc_calculate(s):
+	"Calculate the Hamming code for a 128 byte long string or byte array."
+
+	return map(ord, _ecc_calculate_chunks(s))
+
 def _ecc_check(s, ecc):
 	"""Detect and correct any single bit errors.
 	
@@ -87,6 +185,13 @@ def _ecc_check(s, ecc):
 	computed = ecc_calculate(s)
 	if computed == ecc:
 		return ECC_CHECK_OK
+	return _ecc_correct(s, ecc, computed)
+
+def _ecc_correct(s, ecc, computed):
+	"""Correct a single bit error given the mismatched Hamming codes.
+
+	The parameters are as for ecc_check() with "computed" being the
+	code calculated from the data."""
 
 	#print
 	#_print_bin(0, s.tostring())
@@ -105,13 +210,11 @@ def _ecc_check(s, ecc):
 	#				    lp_comp, cp_comp)
 
 	if lp_comp == 0x7F and cp_comp == 0x07:
-		print "corrected 1"
 		# correctable 1 bit error in data
 		s[lp1_diff] ^= 1 << (cp_diff >> 4)
 		return ECC_CHECK_CORRECTED
 	if ((cp_diff == 0 and lp0_diff == 0 and lp1_diff == 0)
 	      or _popcount(lp_comp) + _popcount(cp_comp) == 1):
-		print "corrected 2"
 		# correctable 1 bit error in ECC
 		# (and/or one of the unused bits was set)
 		ecc[0] = computed[0]
@@ -122,61 +225,80 @@ def _ecc_check(s, ecc):
 	# uncorrectable error
 	return ECC_CHECK_FAILED
 
+def ecc_calculate_pages(buf, page_size = 512):
+	"""Calculate the ECC codes for a run of PS2 memory card pages.
+
+	Returns a string with the three byte codes for each 128 byte
+	chunk of each page, in order."""
+
+	if page_size % 128 == 0:
+		return _ecc_calculate_chunks(buf)
+	return "".join([_ecc_calculate_chunks(buf[off : off + page_size])
+			for off in range(0, len(buf), page_size)])
+
+def ecc_check_pages(buf, spares, page_size = 512):
+	"""Check and correct any single bit errors in a run of pages.
+
+	The data of the pages is given in buf and their spare areas in
+	spares, each concatenated.  Returns the tuple (status, buf,
+	spares) where status is a list of the ECC_CHECK_* result for
+	each page and buf and spares are the corrected data."""
+
+	npages = div_round_up(len(buf), page_size)
+	if npages == 0:
+		return ([], buf, spares)
+	spare_size = len(spares) / npages
+	chunks_per_page = div_round_up(page_size, 128)
+	ecc_size = chunks_per_page * 3
+	computed = ecc_calculate_pages(buf, page_size)
+	if spare_size == ecc_size:
+		stored = spares
+	else:
+		stored = "".join([spares[off : off + ecc_size]
+				  for off in range(0, len(spares),
+						   spare_size)])
+	status = [ECC_CHECK_OK] * npages
+	if computed == stored:
+		return (status, buf, spares)
+
+	new_buf = None
+	for i in range(0, len(stored), 3):
+		if computed[i : i + 3] == stored[i : i + 3]:
+			continue
+		chunk = i / 3
+		page = chunk / chunks_per_page
+		off = page * page_size + chunk % chunks_per_page * 128
+		s = array.array('B')
+		s.fromstring(buf[off : min(off + 128,
+					   page * page_size + page_size)])
+		ecc = map(ord, stored[i : i + 3])
+		r = _ecc_correct(s, ecc, map(ord, computed[i : i + 3]))
+		if r == ECC_CHECK_CORRECTED:
+			if new_buf == None:
+				new_buf = bytearray(buf)
+				new_spares = bytearray(spares)
+			new_buf[off : off + len(s)] = s.tostring()
+			spare_off = (page * spare_size
+				     + chunk % chunks_per_page * 3)
+			new_spares[spare_off : spare_off + 3] = bytearray(ecc)
+		status[page] = max(status[page], r)
+	if new_buf != None:
+		buf = str(new_buf)
+		spares = str(new_spares)
+	return (status, buf, spares)
+
 def ecc_calculate_page(page):
 	"""Return a list of the ECC codes for a PS2 memory card page."""
-	return [ecc_calculate(page[i * 128 : i * 128 + 128])
-		for i in range(div_round_up(len(page), 128))]
+
+	codes = ecc_calculate_pages(page, len(page))
+	return [map(ord, codes[i : i + 3])
+		for i in range(0, len(codes), 3)]
 
 def ecc_check_page(page, spare):
 	"Check and correct any single bit errors in a PS2 memory card page."
 	
-	failed = False
-	corrected = False
-
-	#chunks = [(array.array('B', page[i * 128 : i * 128 + 128]),
-	#	   map(ord, spare[i * 3 : i * 3 + 3]))
-	#	  for i in range(div_round_up(len(page), 128))]
-
-	chunks = []
-	for i in range(div_round_up(len(page), 128)):
-		a = array.array('B')
-		a.fromstring(page[i * 128 : i * 128 + 128])
-		chunks.append((a, map(ord, spare[i * 3 : i * 3 + 3])))
-	
-	r = [ecc_check(s, ecc)
-	     for (s, ecc) in chunks]
-	ret = ECC_CHECK_OK
-	if ECC_CHECK_CORRECTED in r:
-		# rebuild sector and spare from the corrected versions
-		page = "".join([a[0].tostring()
-				for a in chunks])
-		spare = "".join([chr(a[1][i])
-				 for a in chunks
-				 for i in range(3)])
-		ret = ECC_CHECK_CORRECTED
-	if ECC_CHECK_FAILED in r:
-		ret = ECC_CHECK_FAILED
-	return (ret, page, spare)
-
-if mymcsup == None:
-	ecc_calculate = _ecc_calculate
-	ecc_check = _ecc_check
-else:
-	# _c_ubyte_p = ctypes.POINTER(ctypes.c_ubyte)
-	def ecc_calculate(s):
-		aecc = array.array('B', "\0\0\0")
-		cecc = ctypes.c_ubyte.from_address(aecc.buffer_info()[0])
-		mymcsup.ecc_calculate(s, len(s), cecc)
-		return list(aecc)
+	(status, page, spare) = ecc_check_pages(page, spare, len(page))
+	return (status[0], page, spare)
 
-	def ecc_check(s, ecc):
-		cs = ctypes.c_ubyte.from_address(s.buffer_info()[0])
-		# print "%08X" % s.buffer_info()[0]
-		aecc = array.array('B', ecc)
-		cecc = ctypes.c_ubyte.from_address(aecc.buffer_info()[0])
-		ret = mymcsup.ecc_check(cs, len(s), cecc)
-		ecc[0] = aecc[0]
-		ecc[1] = aecc[1]
-		ecc[2] = aecc[2]
-		return ret
-		
+ecc_check = _ecc_check
+ecc_set_backend()
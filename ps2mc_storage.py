@@ -0,0 +1,286 @@
+#
+# ps2mc_storage.py
+#
+
+"""Classes for reading and writing the raw memory card image."""
+
+import os
+from errno import EINTR
+
+try:
+	import mmap
+except ImportError:
+	mmap = None
+
+try:
+	import ctypes
+except ImportError:
+	ctypes = None
+
+def _load_pread():
+	"""Return the C library's pread() and pwrite() functions.
+
+	The 64-bit offset versions are used where they exist.  Returns
+	None if they aren't available."""
+	
+	if ctypes == None or os.name != "posix":
+		return None
+	try:
+		libc = ctypes.CDLL(None, use_errno = True)
+	except EnvironmentError:
+		return None
+	for (read_name, write_name) in [("pread64", "pwrite64"),
+					("pread", "pwrite")]:
+		pread = getattr(libc, read_name, None)
+		pwrite = getattr(libc, write_name, None)
+		if pread != None and pwrite != None:
+			break
+	else:
+		return None
+	pread.restype = ctypes.c_ssize_t
+	pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+			  ctypes.c_int64]
+	pwrite.restype = ctypes.c_ssize_t
+	pwrite.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t,
+			   ctypes.c_int64]
+	return (pread, pwrite)
+
+_pread_functions = _load_pread()
+
+PS2MC_STORAGE_AUTO = "auto"
+PS2MC_STORAGE_FILE = "file"
+PS2MC_STORAGE_MMAP = "mmap"
+PS2MC_STORAGE_PREAD = "pread"
+PS2MC_STORAGE_MEMORY = "memory"
+
+PS2MC_STORAGE_NAMES = [PS2MC_STORAGE_AUTO, PS2MC_STORAGE_FILE,
+		       PS2MC_STORAGE_MMAP, PS2MC_STORAGE_MEMORY]
+if _pread_functions != None:
+	PS2MC_STORAGE_NAMES.insert(3, PS2MC_STORAGE_PREAD)
+
+# granularity of the dirty regions tracked by memory_storage
+PS2MC_MEMORY_DIRTY_CHUNK = 4096
+
+class file_storage(object):
+	"""Access an image through the seek, read and write methods
+	of a file object."""
+
+	def __init__(self, f):
+		self.f = f
+
+	def read(self, offset, size):
+		f = self.f
+		f.seek(offset)
+		return f.read(size)
+
+	def write(self, offset, data):
+		f = self.f
+		f.seek(offset)
+		f.write(data)
+
+	def flush(self):
+		self.f.flush()
+
+	def close(self):
+		pass
+
+class mmap_storage(object):
+	"""Access an image through a memory map of the file.
+
+	Reads are slices of the map and writes are made in place, so
+	neither needs a system call.  The image can't change size, and
+	flush() writes modified pages back with msync().
+
+	Reads aren't zero-copy: each returns a new string copied from
+	the map, as callers expect read() to return a string."""
+
+	def __init__(self, f, writable):
+		f.flush()
+		if writable:
+			access = mmap.ACCESS_WRITE
+		else:
+			access = mmap.ACCESS_READ
+		self.f = f
+		self.map = mmap.mmap(f.fileno(), 0, access = access)
+
+	def read(self, offset, size):
+		return self.map[offset : offset + size]
+
+	def write(self, offset, data):
+		m = self.map
+		end = offset + len(data)
+		if end > len(m):
+			raise IOError, "write past the end of a mapped image"
+		m[offset : end] = str(data)
+
+	def flush(self):
+		self.map.flush()
+
+	def close(self):
+		self.map.close()
+
+class pread_storage(object):
+	"""Access an image with pread() and pwrite() on its file
+	descriptor.
+
+	The C library's functions are called through ctypes, as Python
+	2 has no os.pread().  Neither uses or moves the file position,
+	so no seek is needed.  ctypes releases the interpreter lock
+	during each call, so several threads can read through the
+	same pread_storage object at once.  The rest of ps2mc isn't
+	thread safe, so a ps2mc object still can't be shared between
+	threads."""
+
+	def __init__(self, f):
+		f.flush()
+		self.f = f
+		self.fd = f.fileno()
+		(self._pread, self._pwrite) = _pread_functions
+
+	def _error(self):
+		e = ctypes.get_errno()
+		raise OSError, (e, os.strerror(e))
+
+	def read(self, offset, size):
+		buf = ctypes.create_string_buffer(size)
+		addr = ctypes.addressof(buf)
+		done = 0
+		# short reads happen, keep going until EOF
+		while done < size:
+			n = self._pread(self.fd, addr + done, size - done,
+					offset + done)
+			if n < 0:
+				if ctypes.get_errno() == EINTR:
+					continue
+				self._error()
+			if n == 0:
+				break
+			done += n
+		return buf.raw[:done]
+
+	def write(self, offset, data):
+		data = str(data)
+		while len(data) > 0:
+			n = self._pwrite(self.fd, data, len(data), offset)
+			if n < 0:
+				if ctypes.get_errno() == EINTR:
+					continue
+				self._error()
+			data = data[n:]
+			offset += n
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
+class memory_storage(object):
+	"""Keep the whole image in memory.
+
+	The image is read into a bytearray when the object is created.
+	Writes only change the bytearray, with the regions modified
+	remembered so flush() can write them back to the file in one
+	pass.  The image can grow, so a new image can be built in
+	memory."""
+
+	def __init__(self, f):
+		self.f = f
+		f.seek(0)
+		self.data = bytearray(f.read())
+		self._dirty = set()
+
+	def read(self, offset, size):
+		return str(buffer(self.data, offset, size))
+
+	def write(self, offset, data):
+		end = offset + len(data)
+		image = self.data
+		if end > len(image):
+			image.extend("\0" * (end - len(image)))
+		image[offset : end] = data
+		chunk = PS2MC_MEMORY_DIRTY_CHUNK
+		self._dirty.update(xrange(offset / chunk,
+					  (end + chunk - 1) / chunk))
+
+	def flush(self):
+		if len(self._dirty) == 0:
+			return
+		f = self.f
+		image = self.data
+		chunk = PS2MC_MEMORY_DIRTY_CHUNK
+		dirty = sorted(self._dirty)
+		i = 0
+		while i < len(dirty):
+			j = i + 1
+			while j < len(dirty) and dirty[j] == dirty[i] + (j - i):
+				j += 1
+			start = dirty[i] * chunk
+			f.seek(start)
+			f.write(buffer(image, start, (dirty[j - 1] + 1) * chunk
+				       - start))
+			i = j
+		self._dirty.clear()
+		f.flush()
+
+	def getvalue(self):
+		return str(self.data)
+
+	def close(self):
+		self.data = None
+
+def _has_fd(f):
+	try:
+		f.fileno()
+	except (AttributeError, EnvironmentError):
+		return False
+	return True
+
+def _file_writable(f):
+	mode = getattr(f, "mode", "rb")
+	return "+" in mode or "w" in mode or "a" in mode
+
+def _can_mmap(f):
+	if mmap == None or not _has_fd(f):
+		return False
+	try:
+		return os.fstat(f.fileno()).st_size > 0
+	except EnvironmentError:
+		return False
+
+def _can_pread(f):
+	return _pread_functions != None and _has_fd(f)
+
+def open_storage(f, kind = PS2MC_STORAGE_AUTO):
+	"""Return a storage object for accessing the image file f.
+
+	With PS2MC_STORAGE_AUTO the image is memory mapped if it's a
+	real file.  If that fails pread() and pwrite() are used when
+	the platform has them.  Otherwise, as with file-like objects
+	that have no file descriptor, the file object's methods are
+	used."""
+
+	if kind == PS2MC_STORAGE_AUTO:
+		if _can_mmap(f):
+			try:
+				return mmap_storage(f, _file_writable(f))
+			except EnvironmentError:
+				pass
+		if _can_pread(f):
+			return pread_storage(f)
+		return file_storage(f)
+	if kind == PS2MC_STORAGE_MMAP:
+		if mmap == None:
+			raise ValueError, "mmap not available"
+		return mmap_storage(f, _file_writable(f))
+	if kind == PS2MC_STORAGE_MEMORY:
+		return memory_storage(f)
+	if kind == PS2MC_STORAGE_PREAD:
+		if _pread_functions == None:
+			raise ValueError, "pread() not available"
+		if not _has_fd(f):
+			raise ValueError, "image has no file descriptor"
+		return pread_storage(f)
+	if kind == PS2MC_STORAGE_FILE:
+		return file_storage(f)
+	raise ValueError, "unknown storage type %s" % repr(kind)